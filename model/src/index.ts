@@ -65,6 +65,8 @@ export type BlockArgs = {
   cloneClusteringMode?: CloneClusteringMode; // default: 'relaxed'
   stopCodonTypes?: StopCodonType[];
   stopCodonReplacements?: StopCodonReplacements;
+  // If true, the pairing job also writes the read-level pairing report (pairingReport output)
+  pairingReport?: boolean;
 };
 
 export type UiState = {
@@ -158,6 +160,7 @@ export const platforma = BlockModelV3.create(dataModel)
       cloneClusteringMode: data.cloneClusteringMode,
       stopCodonTypes: data.stopCodonTypes,
       stopCodonReplacements: data.stopCodonReplacements,
+      pairingReport: data.pairingReport,
     };
   })
 
@@ -284,6 +287,12 @@ export const platforma = BlockModelV3.create(dataModel)
     parseResourceMap(ctx.outputs?.resolve("reportsIGLight"), (acc) => acc.getFileHandle(), false),
   )
 
+  .output("pairingReport", (ctx) => {
+    const acc = ctx.outputs?.resolve("pairingReport");
+    if (!acc || !acc.getInputsLocked()) return undefined;
+    return parseResourceMap(acc, (acc) => acc.getFileHandle(), true);
+  })
+
   .output("isRunning", (ctx) => ctx.outputs?.getIsReadyOrError() === false)
 
   .outputWithStatus("pt", (ctx) => {
@@ -0,0 +1,59 @@
+"""Micro-benchmark: batched clonotypeKey hashing vs the per-row lambda.
+
+    python software/bench/clonotype_key.py --rows 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "assemble-scfv"))
+
+from clonotype_key import hash_clonotype_key, hash_clonotype_keys  # noqa: E402
+
+
+def formatted_keys(rows: int, seed: int) -> pl.Series:
+    rng = random.Random(seed)
+    keys = []
+    for _ in range(rows):
+        heavy = "".join(rng.choices("ACGT", k=60))
+        light = "".join(rng.choices("ACGT", k=60))
+        keys.append(
+            f"{heavy}-{light}-IGHV{rng.randint(1, 7)}-{rng.randint(1, 70)}-IGKV{rng.randint(1, 6)}"
+            f"-IGHJ{rng.randint(1, 6)}-IGKJ{rng.randint(1, 5)}-IGHG1-IGKC")
+    return pl.Series("clonotypeKey", keys)
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--rows", type=int, default=1_000_000)
+    p.add_argument("--repeats", type=int, default=3)
+    p.add_argument("--seed", type=int, default=0)
+    args = p.parse_args()
+
+    keys = formatted_keys(args.rows, args.seed)
+    candidates = {
+        "lambda (map_elements)": lambda: keys.map_elements(
+            hash_clonotype_key, return_dtype=pl.String),
+        "batched": lambda: hash_clonotype_keys(keys),
+    }
+
+    results = {}
+    for name, run in candidates.items():
+        best = float("inf")
+        for _ in range(args.repeats):
+            start = time.perf_counter()
+            results[name] = run()
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:24s} {best:8.3f} s  {args.rows / best / 1e6:8.2f} Mkeys/s")
+
+    reference, batched = results.values()
+    if not reference.equals(batched):
+        sys.exit("batched keys differ from the reference lambda")
+
+
+if __name__ == "__main__":
+    main()
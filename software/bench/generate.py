@@ -0,0 +1,195 @@
+"""Deterministic synthetic MiXCR exports for the assemble-scfv benchmarks.
+
+    python software/bench/generate.py --out data --heavy-clones 10000 --reads-per-clone 10
+
+Writes hc/lc.clones.tsv and hc/lc.alignments.tsv (only the heavy pair with
+--no-light) with the columns the workflow exports. The same arguments and seed
+always produce the same files.
+"""
+import argparse
+import os
+import sys
+from typing import List, Optional, Tuple
+
+import numpy as np
+import polars as pl
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src", "assemble-scfv"))
+
+from construct_annotations import base36_encode  # noqa: E402
+from main import (HC_ALIGNMENTS_FILE, HC_CLONES_FILE, LC_ALIGNMENTS_FILE,  # noqa: E402
+                  LC_CLONES_FILE)
+from translation import translate_series  # noqa: E402
+
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+# VDJ region lengths (nt) drawn for clones; not all of them are in frame
+VDJ_LENGTHS = [330, 342, 351, 352, 360, 363]
+CDR3_LENGTH = 45
+UMI_LENGTH = 12
+# Alignments are generated and appended in chunks of this many reads
+CHUNK_READS = 2_000_000
+CHAIN_PREFIXES = {"heavy": "IGH", "light": "IGK"}
+
+
+def random_sequences(rng: np.random.Generator, lengths: np.ndarray) -> pl.Series:
+    """Random nucleotide sequences of the given lengths."""
+    codes = NUCLEOTIDES[rng.integers(0, 4, size=int(lengths.sum()))]
+    ends = np.cumsum(lengths)
+    text = codes.tobytes().decode()
+    return pl.Series([text[end - length:end] for end, length in zip(ends, lengths)])
+
+
+def annotation(regions: List[Tuple[int, int]], codes: str) -> str:
+    """MiXCR annotation string: `code:start+length` in base36, '|'-separated."""
+    return "|".join(
+        f"{code}:{base36_encode(int(start))}+{base36_encode(int(end - start))}"
+        for code, (start, end) in zip(codes, regions))
+
+
+def clone_table(rng: np.random.Generator, clones: int, chain: str,
+                abundance: np.ndarray, umi: bool, c_gene: bool) -> pl.DataFrame:
+    prefix = CHAIN_PREFIXES[chain]
+    lengths = rng.choice(VDJ_LENGTHS, size=clones)
+    nt = random_sequences(rng, lengths)
+    cdr3_start = lengths - CDR3_LENGTH - 33
+
+    # CDRs are coded 1..3, V/D/J segments 1..3; amino acid positions are nt // 3
+    n_cdrs, n_segments, aa_cdrs, aa_segments = [], [], [], []
+    for length, start in zip(lengths, cdr3_start):
+        cdrs = [(75, 99), (150, 174), (start, start + CDR3_LENGTH)]
+        segments = [(0, start + 6), (start + 12, start + 20), (start + 26, length)]
+        n_cdrs.append(annotation(cdrs, "123"))
+        n_segments.append(annotation(segments, "123"))
+        aa_cdrs.append(annotation([(s // 3, e // 3) for s, e in cdrs], "123"))
+        aa_segments.append(annotation([(s // 3, e // 3) for s, e in segments], "123"))
+
+    fraction = abundance / max(abundance.sum(), 1)
+    df = pl.DataFrame({
+        "cloneId": np.arange(clones),
+        "readCount": abundance,
+        "readFraction": fraction,
+    })
+    if umi:
+        molecules = np.maximum(abundance // 3, 1)
+        df = df.with_columns(
+            uniqueMoleculeCount=pl.Series(molecules),
+            uniqueMoleculeFraction=pl.Series(molecules / molecules.sum()))
+
+    genes = {
+        "bestVGene": [f"{prefix}V{v}-{g}" for v, g in zip(
+            rng.integers(1, 8, clones), rng.integers(1, 70, clones))],
+        "bestJGene": [f"{prefix}J{j}" for j in rng.integers(1, 7, clones)],
+    }
+    if c_gene:
+        genes["bestCGene"] = [f"{prefix}{'G' if chain == 'heavy' else 'C'}{c}"
+                              for c in rng.integers(1, 4, clones)]
+    df = df.with_columns(
+        targetSequences=nt.str.slice(pl.Series(cdr3_start), CDR3_LENGTH),
+        **{name: pl.Series(values) for name, values in genes.items()},
+        nSeqVDJRegion=nt,
+        aaSeqVDJRegion=translate_series(nt),
+        nAnnotationOfCDRsForVDJRegion=pl.Series(n_cdrs),
+        nAnnotationOfSegmentsForVDJRegion=pl.Series(n_segments),
+        aaAnnotationOfCDRsForVDJRegion=pl.Series(aa_cdrs),
+        aaAnnotationOfSegmentsForVDJRegion=pl.Series(aa_segments),
+        topChains=pl.lit(prefix),
+    )
+    return df.select(pl.all().cast(pl.String))
+
+
+def write_alignments(rng: np.random.Generator, path: str, clone_ids: np.ndarray,
+                     read_ids: np.ndarray, molecules: Optional[np.ndarray],
+                     umis: Optional[pl.Series]) -> None:
+    order = rng.permutation(len(read_ids))
+    with open(path, "w") as out:
+        for offset in range(0, len(order), CHUNK_READS):
+            rows = order[offset:offset + CHUNK_READS]
+            chunk = pl.DataFrame({"cloneId": clone_ids[rows], "read": read_ids[rows]})
+            columns = [
+                pl.col("cloneId").cast(pl.String),
+                pl.format("@BENCH:1:FCX:1:{}:{}:{} 1:N:0:1",
+                          pl.col("read") // 1_000_000 + 1101,
+                          pl.col("read") // 1000 % 1000,
+                          pl.col("read") % 1000).alias("descrR1"),
+            ]
+            if umis is not None:
+                chunk = chunk.with_columns(umi=umis.gather(molecules[rows]))
+                columns.append(pl.col("umi").alias("tagValueUMI"))
+            chunk.select(columns).write_csv(out, separator="\t", include_header=offset == 0)
+
+
+def umi_sequences(rng: np.random.Generator, molecules: int) -> pl.Series:
+    """A random UMI per molecule; reads of the same molecule share it."""
+    codes = NUCLEOTIDES[rng.integers(0, 4, size=(molecules, UMI_LENGTH))]
+    return pl.Series(codes.view(f"S{UMI_LENGTH}").ravel()).cast(pl.String)
+
+
+def generate(out: str, heavy_clones: int, light_clones: int, reads_per_clone: float,
+             pairing_rate: float, unassigned_rate: float, umi: bool, c_gene: bool,
+             no_light: bool, seed: int) -> None:
+    rng = np.random.default_rng(seed)
+    os.makedirs(out, exist_ok=True)
+    reads = int(heavy_clones * reads_per_clone)
+
+    # Skewed clone sizes, as in real repertoires: a few expanded clones, a long tail
+    weights = rng.pareto(1.2, heavy_clones) + 1
+    heavy = rng.choice(heavy_clones, size=reads, p=weights / weights.sum())
+    # Every heavy clone has its light partner, with some promiscuous pairing
+    partner = rng.integers(0, light_clones, heavy_clones)
+    light = np.where(rng.random(reads) < 0.9, partner[heavy], rng.integers(0, light_clones, reads))
+
+    read_ids = np.arange(reads)
+    molecules, umis = None, None
+    if umi:
+        umis = umi_sequences(rng, max(reads // 3, 1))
+        molecules = rng.integers(0, len(umis), reads)
+
+    # A read is paired with probability pairing_rate, otherwise only one chain has it
+    paired = rng.random(reads) < pairing_rate
+    heavy_side = rng.random(reads) < 0.5
+    in_heavy = paired | heavy_side
+    in_light = paired | ~heavy_side
+    heavy = np.where(rng.random(reads) < unassigned_rate, -1, heavy)
+    light = np.where(rng.random(reads) < unassigned_rate, -1, light)
+
+    clone_table(rng, heavy_clones, "heavy", np.bincount(heavy[heavy >= 0], minlength=heavy_clones),
+                umi, c_gene).write_csv(os.path.join(out, HC_CLONES_FILE), separator="\t")
+    write_alignments(rng, os.path.join(out, HC_ALIGNMENTS_FILE), heavy[in_heavy],
+                     read_ids[in_heavy], molecules[in_heavy] if umi else None, umis)
+    if no_light:
+        return
+    clone_table(rng, light_clones, "light", np.bincount(light[light >= 0], minlength=light_clones),
+                umi, c_gene).write_csv(os.path.join(out, LC_CLONES_FILE), separator="\t")
+    write_alignments(rng, os.path.join(out, LC_ALIGNMENTS_FILE), light[in_light],
+                     read_ids[in_light], molecules[in_light] if umi else None, umis)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--out", required=True, help="output directory")
+    p.add_argument("--heavy-clones", dest="heavy_clones", type=int, default=10_000)
+    p.add_argument("--light-clones", dest="light_clones", type=int,
+                   help="defaults to 80%% of the heavy clones")
+    p.add_argument("--reads-per-clone", dest="reads_per_clone", type=float, default=10)
+    p.add_argument("--pairing-rate", dest="pairing_rate", type=float, default=0.8,
+                   help="fraction of reads present in both the heavy and light alignments")
+    p.add_argument("--unassigned-rate", dest="unassigned_rate", type=float, default=0.1,
+                   help="fraction of alignments not assigned to a clone (cloneId -1)")
+    p.add_argument("--no-umi", dest="umi", action="store_false", help="omit the UMI tag column")
+    p.add_argument("--c-gene", dest="c_gene", action="store_true", help="export bestCGene")
+    p.add_argument("--no-light", dest="no_light", action="store_true",
+                   help="write the heavy chain exports only (light-impute mode)")
+    p.add_argument("--seed", type=int, default=0)
+    return p
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    generate(args.out, args.heavy_clones,
+             args.light_clones or max(1, int(args.heavy_clones * 0.8)),
+             args.reads_per_clone, args.pairing_rate, args.unassigned_rate,
+             args.umi, args.c_gene, args.no_light, args.seed)
+
+
+if __name__ == "__main__":
+    main()
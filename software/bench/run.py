@@ -0,0 +1,179 @@
+"""Benchmark runner: times the assemble-scfv entrypoints at several scales.
+
+    python software/bench/run.py --scales 1e4,1e5,1e6 --check
+    python software/bench/run.py --scales 1e4,1e5 --update-baseline
+
+Every scale is a synthetic dataset from generate.py (cached in --workdir); each
+stage runs in its own process, and its wall time (best of --repeats) and peak
+RSS are recorded. With --check the results are compared to the stored
+baselines and the run fails if a stage got slower or bigger than --threshold.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from typing import Dict, List, Tuple
+
+from generate import generate
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPTS_DIR = os.path.join(BENCH_DIR, "..", "src", "assemble-scfv")
+BASELINES_FILE = os.path.join(BENCH_DIR, "baselines.json")
+
+LINKER = "GGTGGAGGCGGTTCA"
+HINGE = "GATCCG"
+LIGHT_IMPUTE = "GACATCCAGATGACCCAGTCTCCATCCTCCCTGTCTGCATCTGTAGGAGACAGAGTCACCATCACTTGC"
+WORKFLOW_ARGS = ["--engine", "streaming", "--read-id-key", "hash"]
+
+# Stage name, script and arguments; stages run in this order in the dataset directory
+STAGES = [
+    ("assemble", "main.py", WORKFLOW_ARGS + ["--output", "assembled.tsv"]),
+    ("annotate", "construct_annotations.py", ["--input", "assembled.tsv", "--output", "annotated.tsv"]),
+    ("assemble-annotate", "assemble_annotate.py", WORKFLOW_ARGS + ["--output", "result.tsv"]),
+]
+
+# Differences below these are noise, whatever the relative threshold says
+MIN_WALL_DELTA_S = 0.5
+MIN_RSS_DELTA_MIB = 32
+
+
+def parse_scales(value: str) -> List[int]:
+    return [int(float(scale)) for scale in value.split(",") if scale]
+
+
+def dataset(workdir: str, reads: int, args: argparse.Namespace) -> Tuple[str, str]:
+    """Name and directory of the dataset of `reads` reads, generated on first use."""
+    heavy_clones = max(1, min(reads // args.reads_per_clone, args.max_clones))
+    name = f"reads{reads}-clones{heavy_clones}-{'umi' if args.umi else 'plain'}" \
+           f"{'-nolight' if args.no_light else ''}-seed{args.seed}"
+    path = os.path.join(workdir, name)
+    if not os.path.isdir(path):
+        print(f"generating {name}", file=sys.stderr)
+        generate(path + ".tmp", heavy_clones, max(1, int(heavy_clones * 0.8)),
+                 reads / heavy_clones, args.pairing_rate, 0.1, args.umi, False,
+                 args.no_light, args.seed)
+        os.rename(path + ".tmp", path)
+    return name, path
+
+
+def run_stage(cwd: str, script: str, stage_args: List[str]) -> Tuple[float, float]:
+    """Runs one stage in a fresh interpreter; returns wall seconds and peak RSS in MiB."""
+    start = time.perf_counter()
+    proc = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, script)] + stage_args, cwd=cwd)
+    # wait4 reports the resource usage of this child alone
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - start
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, proc.args)
+    return wall, usage.ru_maxrss / 1024
+
+
+def run(args: argparse.Namespace) -> Dict[str, Dict[str, dict]]:
+    common = ["--linker", LINKER, "--hinge", HINGE, "--order", args.order]
+    if args.no_light:
+        common += ["--no-light", "--light-impute", LIGHT_IMPUTE]
+    results: Dict[str, Dict[str, dict]] = {}
+    for reads in args.scales:
+        name, path = dataset(args.workdir, reads, args)
+        # results are keyed by dataset and order, so baselines compare like with like
+        key = f"{name}-{args.order}"
+        results[key] = {}
+        for stage, script, stage_args in STAGES:
+            if stage == "annotate":
+                stage_args = stage_args + ["--order", args.order, "--linker", LINKER, "--hinge", HINGE]
+            else:
+                stage_args = common + stage_args
+            if args.profile:
+                stage_args = stage_args + ["--profile-json", f"profile-{stage}.json"]
+            runs = [run_stage(path, script, stage_args) for _ in range(args.repeats)]
+            wall = min(w for w, _ in runs)
+            rss = max(r for _, r in runs)
+            results[key][stage] = {"wall_s": round(wall, 3), "peak_rss_mib": round(rss, 1)}
+            if args.profile:
+                with open(os.path.join(path, f"profile-{stage}.json")) as f:
+                    results[key][stage]["profile"] = json.load(f)["stages"]
+            print(f"{key:40s} {stage:20s} {wall:9.3f} s {rss:9.1f} MiB", flush=True)
+    return results
+
+
+def regressions(results: dict, baselines: dict, threshold: float) -> List[str]:
+    found = []
+    for key, stages in results.items():
+        for stage, measured in stages.items():
+            base = baselines.get(key, {}).get(stage)
+            if base is None:
+                continue
+            for metric, slack in (("wall_s", MIN_WALL_DELTA_S), ("peak_rss_mib", MIN_RSS_DELTA_MIB)):
+                limit = max(base[metric] * (1 + threshold), base[metric] + slack)
+                if measured[metric] > limit:
+                    found.append(f"{key} {stage}: {metric} {measured[metric]} > "
+                                 f"baseline {base[metric]} (+{threshold:.0%})")
+    return found
+
+
+def build_parser() -> argparse.ArgumentParser:
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    p.add_argument("--scales", type=parse_scales, default=parse_scales("1e4,1e5,1e6"),
+                   help="comma-separated read counts, e.g. 1e4,1e6,1e8")
+    p.add_argument("--workdir", default=os.path.join(BENCH_DIR, "bench-data"), help="where datasets are generated and cached")
+    p.add_argument("--repeats", type=int, default=1)
+    p.add_argument("--order", default="hl", choices=["hl", "lh"])
+    p.add_argument("--reads-per-clone", dest="reads_per_clone", type=int, default=10)
+    p.add_argument("--max-clones", dest="max_clones", type=int, default=200_000,
+                   help="clone count cap; larger scales get more reads per clone")
+    p.add_argument("--pairing-rate", dest="pairing_rate", type=float, default=0.8)
+    p.add_argument("--no-umi", dest="umi", action="store_false")
+    p.add_argument("--no-light", dest="no_light", action="store_true")
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--profile", action="store_true",
+                   help="run the scripts with --profile-json and keep their per-stage "
+                        "breakdown in the results (profiled runs execute stage by stage)")
+    p.add_argument("--output", help="write the results as JSON")
+    p.add_argument("--baselines", default=BASELINES_FILE)
+    p.add_argument("--threshold", type=float, help="allowed relative regression; "
+                   "defaults to the one stored with the baselines")
+    p.add_argument("--check", action="store_true", help="fail on regressions against the baselines")
+    p.add_argument("--update-baseline", dest="update_baseline", action="store_true",
+                   help="store the results as the new baselines of the measured scales")
+    return p
+
+
+def main() -> None:
+    args = build_parser().parse_args()
+    os.makedirs(args.workdir, exist_ok=True)
+    results = run(args)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    stored = {"threshold": 0.25, "results": {}}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as f:
+            stored = json.load(f)
+    threshold = args.threshold if args.threshold is not None else stored["threshold"]
+
+    if args.update_baseline:
+        # cpu_count is the host's; the affinity mask is what a container may use
+        usable = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        stored["machine"] = {"platform": platform.platform(), "cpus": os.cpu_count(),
+                             "usable_cpus": usable, "python": platform.python_version()}
+        stored["results"].update(results)
+        with open(args.baselines, "w") as f:
+            json.dump(stored, f, indent=2)
+            f.write("\n")
+
+    if args.check:
+        found = regressions(results, stored["results"], threshold)
+        for line in found:
+            print("REGRESSION " + line, file=sys.stderr)
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
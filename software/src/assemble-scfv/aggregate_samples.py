@@ -0,0 +1,219 @@
+"""Merges the clonotype tables of many samples into one row per clonotypeKey.
+
+Every input is a per-sample `assemble-scfv --sort-by-key` output. The inputs
+are merged k-way in key order, batch by batch, so memory is bounded by the
+number of inputs times --batch-mib and not by the total row count.
+"""
+import argparse
+import json
+from typing import Dict, Iterator, List, Optional
+
+import polars as pl
+
+from profiling import DISABLED, Profiler
+from tables import tsv_batches
+
+KEY_COL = "clonotypeKey"
+SAMPLE_COUNT_COL = "sampleCount"
+SUM_SUFFIX = "Sum"
+CDR_MUTATIONS_COL = "nAAMutationsCDR"
+FWR_MUTATIONS_COL = "nAAMutationsFWR"
+CDR_FRACTION_COL = "fractionCDRMutations"
+# Cell value MiXCR writes for regions not covered; a missing value when numeric
+NOT_COVERED = "region_not_covered"
+# polars dtypes of the column value types (pl7.app valueType)
+VALUE_TYPES = {"Int": pl.Int32, "Long": pl.Int64, "Double": pl.Float64}
+# Order of an input's rows, which breaks abundance ties in input order
+ORDER_COL = "_order"
+
+
+class SampleMerge:
+    """What is merged and how, from the workflow's parameters.
+
+    `params` holds mainAbundanceColumnNormalized (the maxBy column),
+    mainAbundanceColumnUnnormalized (summed), cloneColumns (taken from the
+    most abundant row), cloneColumnSpecs (their value types) and shmMapping
+    (heavyColumn + lightColumn -> outputColumn).
+    """
+
+    def __init__(self, params: dict):
+        self.normalized: str = params["mainAbundanceColumnNormalized"]
+        self.unnormalized: str = params["mainAbundanceColumnUnnormalized"]
+        self.shm_mapping: List[dict] = params.get("shmMapping") or []
+        shm_cols = [col for mapping in self.shm_mapping
+                    for col in (mapping["heavyColumn"], mapping.get("lightColumn")) if col]
+        self.attribute_cols = list(dict.fromkeys(
+            [col for col in params["cloneColumns"] if col != KEY_COL] + shm_cols))
+
+        self.dtypes: Dict[str, pl.DataType] = {}
+        for spec in params.get("cloneColumnSpecs") or []:
+            dtype = VALUE_TYPES.get((spec.get("spec") or {}).get("valueType"))
+            if dtype is not None:
+                self.dtypes[spec["column"]] = dtype
+        self.dtypes.update({col: pl.Int32 for col in shm_cols})
+        self.dtypes[self.normalized] = pl.Float64
+        self.dtypes[self.unnormalized] = pl.Int64
+        self.columns = list(dict.fromkeys(
+            [KEY_COL] + self.attribute_cols + [self.normalized, self.unnormalized]))
+
+    def prepare(self, batch: pl.DataFrame, path: str) -> pl.DataFrame:
+        """The merged columns of an input batch, numeric ones parsed."""
+        missing = [col for col in self.columns if col not in batch.columns]
+        if missing:
+            raise ValueError(f"{path} lacks column(s) {', '.join(missing)}")
+        return batch.select(
+            pl.when(pl.col(col) == NOT_COVERED).then(None).otherwise(pl.col(col))
+            .cast(self.dtypes[col]).alias(col) if col in self.dtypes else pl.col(col)
+            for col in self.columns
+        )
+
+    def aggregate(self, rows: pl.DataFrame) -> pl.DataFrame:
+        """One row per key of `rows` (the inputs' rows of a key range, in input
+        order): attributes of the most abundant row, sample count and sum."""
+        return rows.with_row_index(ORDER_COL).sort(
+            [KEY_COL, self.normalized, ORDER_COL], descending=[False, True, False], nulls_last=True
+        ).group_by(KEY_COL, maintain_order=True).agg(
+            [pl.col(col).first() for col in self.attribute_cols] + [
+                pl.col(self.normalized).count().alias(SAMPLE_COUNT_COL),
+                pl.col(self.unnormalized).sum().alias(self.unnormalized + SUM_SUFFIX),
+            ]
+        )
+
+    def finish(self, merged: pl.DataFrame) -> pl.DataFrame:
+        """Adds the heavy + light mutation counts and the CDR mutation fraction."""
+        if not self.shm_mapping:
+            return merged
+        merged = merged.with_columns(
+            (pl.col(m["heavyColumn"]) + pl.col(m["lightColumn"]) if m.get("lightColumn")
+             else pl.col(m["heavyColumn"])).alias(m["outputColumn"])
+            for m in self.shm_mapping
+        )
+        cdr = pl.col(CDR_MUTATIONS_COL).cast(pl.Float64)
+        fwr = pl.col(FWR_MUTATIONS_COL).cast(pl.Float64)
+        return merged.with_columns(
+            pl.when(cdr.is_not_null() & fwr.is_not_null() & (cdr + fwr > 0.0))
+            .then(cdr / (cdr + fwr)).otherwise(1.0).alias(CDR_FRACTION_COL)
+        )
+
+
+class SortedInput:
+    """Batches of one input, checked to be sorted by key and held until merged."""
+
+    def __init__(self, path: str, merge: SampleMerge, batch_bytes: int):
+        self.path = path
+        self.merge = merge
+        self.batches = tsv_batches(path, batch_bytes, ahead=1)
+        self.rows: Optional[pl.DataFrame] = None
+        self.exhausted = False
+        self.last_key: Optional[str] = None
+
+    def fill(self) -> None:
+        """Reads until the held rows span more than one key, or the input ends,
+        so the last held key is the only one that may continue."""
+        while not self.exhausted and (self.rows is None or self.rows.height == 0
+                                      or self.rows[0, KEY_COL] == self.rows[-1, KEY_COL]):
+            batch = next(self.batches, None)
+            if batch is None:
+                self.exhausted = True
+                break
+            batch = self.merge.prepare(batch, self.path)
+            keys = batch.get_column(KEY_COL)
+            if keys.null_count() or not keys.is_sorted() or (
+                    self.last_key is not None and batch.height and keys[0] < self.last_key):
+                raise ValueError(f"{self.path} is not sorted by {KEY_COL} "
+                                 f"(write it with assemble-scfv --sort-by-key)")
+            if batch.height:
+                self.last_key = keys[-1]
+            self.rows = batch if self.rows is None else pl.concat([self.rows, batch])
+
+    def take(self, bound: Optional[str]) -> pl.DataFrame:
+        """Removes and returns the held rows with keys below `bound` (all if None)."""
+        if self.rows is None:
+            return pl.DataFrame()
+        if bound is None:
+            taken, self.rows = self.rows, self.rows.clear()
+            return taken
+        split = self.rows.get_column(KEY_COL).search_sorted(bound, side="left")
+        taken, self.rows = self.rows.head(split), self.rows.slice(split)
+        return taken
+
+
+def merge_sorted(paths: List[str], merge: SampleMerge, batch_bytes: int) -> Iterator[pl.DataFrame]:
+    """Aggregated rows of the inputs, in key order, a key range at a time."""
+    inputs = [SortedInput(path, merge, batch_bytes) for path in paths]
+    try:
+        while True:
+            for source in inputs:
+                source.fill()
+            # keys below the smallest last key of an unfinished input are complete
+            open_keys = [source.rows[-1, KEY_COL] for source in inputs if not source.exhausted]
+            bound = min(open_keys) if open_keys else None
+            rows = [taken for taken in (source.take(bound) for source in inputs) if taken.height]
+            if rows:
+                yield merge.aggregate(pl.concat(rows))
+            if bound is None:
+                return
+    finally:
+        # stop the readers now rather than at interpreter exit, when their
+        # threads can no longer run
+        for source in inputs:
+            source.batches.close()
+
+
+def aggregate_samples(
+    paths: List[str],
+    params: dict,
+    output: str,
+    batch_bytes: int,
+    profiler: Profiler = DISABLED
+) -> int:
+    """Writes the merged table to `output`; returns its row count."""
+    merge = SampleMerge(params)
+    rows = 0
+    with profiler.measure("merge", output=output) as record:
+        with open(output, "wb") as f:
+            for chunk in merge_sorted(paths, merge, batch_bytes):
+                merge.finish(chunk).write_csv(f, separator="\t", include_header=rows == 0)
+                rows += chunk.height
+            if rows == 0:
+                merge.finish(merge.aggregate(pl.DataFrame(
+                    schema={col: merge.dtypes.get(col, pl.String) for col in merge.columns}
+                ))).write_csv(f, separator="\t")
+        record["rows_out"] = rows
+    return rows
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("inputs", nargs="+", help="per-sample tables sorted by clonotypeKey")
+    parser.add_argument(
+        "--params",
+        required=True,
+        help="JSON with mainAbundanceColumnNormalized, mainAbundanceColumnUnnormalized, "
+             "cloneColumns, cloneColumnSpecs and shmMapping, as the workflow passes them"
+    )
+    parser.add_argument("--output", required=True)
+    parser.add_argument(
+        "--batch-mib",
+        dest="batch_mib",
+        type=float,
+        default=1,
+        help="MiB read from every input at a time; memory grows with this times the "
+             "number of inputs"
+    )
+    parser.add_argument(
+        "--profile-json",
+        dest="profile_json",
+        help="write wall time, CPU time, row counts and peak RSS to this JSON file"
+    )
+    args = parser.parse_args()
+    with open(args.params) as f:
+        params = json.load(f)
+
+    profiler = Profiler(args.profile_json)
+    aggregate_samples(args.inputs, params, args.output, int(args.batch_mib * 2 ** 20), profiler)
+    profiler.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+import argparse
+
+from construct_annotations import add_construct_annotations
+from main import assemble, build_parser, check_pairing_args, with_intermediate_dtypes
+from profiling import DISABLED, Profiler
+from tables import table_format, write_table
+
+
+def assemble_annotate(args: argparse.Namespace, profiler: Profiler = DISABLED) -> None:
+    """Assembles the constructs and adds their annotations in one process.
+
+    Same output as running main.py and construct_annotations.py one after the
+    other, without the intermediate table round-trip and second interpreter.
+    """
+    result = assemble(args, profiler)
+    if table_format(args.output) != "tsv":
+        result = with_intermediate_dtypes(result)
+    df = result.collect(engine=args.engine)
+    with profiler.measure("construct annotations", df.height) as record:
+        df = add_construct_annotations(df, args.order, args.linker, args.hinge)
+        record["rows_out"] = df.height
+    with profiler.measure("write", df.height, output=args.output) as record:
+        write_table(df, args.output)
+        record["rows_out"] = df.height
+    profiler.write()
+
+
+def main() -> None:
+    parser = build_parser("Assembles scFv from MiXCR alignments and annotates the constructs")
+    args = parser.parse_args()
+    if args.pairs_only or args.estimate:
+        parser.error("--pairs-only and --estimate are options of main.py")
+    check_pairing_args(parser, args)
+    assemble_annotate(args, Profiler(args.profile_json, args.engine))
+
+
+if __name__ == "__main__":
+    main()
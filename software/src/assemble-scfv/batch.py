@@ -0,0 +1,157 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple
+
+import polars as pl
+
+from assemble_annotate import assemble_annotate
+from estimate import estimate
+from main import (HC_ALIGNMENTS_FILE, HC_CLONES_FILE, LC_ALIGNMENTS_FILE, LC_CLONES_FILE, build_parser,
+                  check_pairing_args)
+from profiling import Profiler
+from tables import input_path
+
+# Manifest columns: the sample id and its directory with the MiXCR exports,
+# optionally the output path (relative to that directory, like --output)
+SAMPLE_COL = "sampleId"
+DIRECTORY_COL = "directory"
+OUTPUT_COL = "output"
+
+
+def read_manifest(path: str) -> List[Tuple[str, str, Optional[str]]]:
+    """Samples of a manifest TSV, with their directories made absolute."""
+    manifest = pl.read_csv(path, separator="\t", infer_schema=False)
+    missing = [col for col in (SAMPLE_COL, DIRECTORY_COL) if col not in manifest.columns]
+    if missing:
+        raise ValueError(f"manifest {path} lacks column(s) {', '.join(missing)}")
+    if manifest.get_column(SAMPLE_COL).is_duplicated().any():
+        raise ValueError(f"manifest {path} lists a {SAMPLE_COL} more than once")
+    outputs = manifest.get_column(OUTPUT_COL) if OUTPUT_COL in manifest.columns \
+        else pl.repeat(None, manifest.height, dtype=pl.String, eager=True)
+    return [(sample, os.path.abspath(directory), output) for sample, directory, output in zip(
+        manifest.get_column(SAMPLE_COL), manifest.get_column(DIRECTORY_COL), outputs)]
+
+
+def predicted_memory_gib(directory: str, no_light: bool) -> float:
+    """Peak memory of one sample as predicted by `main.py --estimate`."""
+    files = [HC_CLONES_FILE, HC_ALIGNMENTS_FILE] if no_light \
+        else [HC_CLONES_FILE, HC_ALIGNMENTS_FILE, LC_CLONES_FILE, LC_ALIGNMENTS_FILE]
+    paths = [input_path(os.path.join(directory, name)) for name in files]
+    return estimate(*paths)["predictedPeakMemoryGiB"]
+
+
+def run_sample(args: argparse.Namespace, directory: str) -> float:
+    """Processes one sample in its directory, as the single-sample CLI run there
+    would; returns the wall time."""
+    start = time.perf_counter()
+    os.chdir(directory)
+    assemble_annotate(args, Profiler(args.profile_json, args.engine))
+    return time.perf_counter() - start
+
+
+def run_batch(
+    args: argparse.Namespace,
+    samples: List[Tuple[str, str, Optional[str]]]
+) -> Dict[str, Optional[str]]:
+    """Runs the samples on a pool of `args.jobs` workers, starting a sample only
+    while the predicted peak memory of those running stays within
+    `args.batch_memory` (a sample above it alone runs alone). Returns the error
+    of every failed sample, None for those that succeeded."""
+    if "POLARS_MAX_THREADS" not in os.environ:
+        # set before the workers import polars, so they share the cores
+        os.environ["POLARS_MAX_THREADS"] = str(max(1, (os.cpu_count() or 1) // args.jobs))
+
+    pending = deque(samples)
+    running: Dict[Future, Tuple[str, float]] = {}
+    errors: Dict[str, Optional[str]] = {}
+    used_gib = 0.0
+    need_gib: Optional[float] = None
+    # polars is multi-threaded, so workers are spawned rather than forked
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=args.jobs, mp_context=context) as pool:
+        while pending or running:
+            while pending and len(running) < args.jobs:
+                sample, directory, output = pending[0]
+                if need_gib is None and args.batch_memory is not None:
+                    try:
+                        need_gib = predicted_memory_gib(directory, args.no_light)
+                    except Exception as e:
+                        pending.popleft()
+                        errors[sample] = f"{type(e).__name__}: {e}"
+                        print(f"{sample}\tfailed\t{errors[sample]}", file=sys.stderr, flush=True)
+                        continue
+                need_gib = need_gib or 0.0
+                if running and args.batch_memory is not None and used_gib + need_gib > args.batch_memory:
+                    break
+                pending.popleft()
+                sample_args = argparse.Namespace(**vars(args))
+                sample_args.output = output or args.output
+                running[pool.submit(run_sample, sample_args, directory)] = (sample, need_gib)
+                used_gib += need_gib
+                need_gib = None
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                sample, gib = running.pop(future)
+                used_gib -= gib
+                try:
+                    wall = future.result()
+                    errors[sample] = None
+                    print(f"{sample}\tok\t{wall:.3f}", file=sys.stderr, flush=True)
+                except Exception as e:
+                    errors[sample] = f"{type(e).__name__}: {e}"
+                    print(f"{sample}\tfailed\t{errors[sample]}", file=sys.stderr, flush=True)
+    return errors
+
+
+def main() -> None:
+    parser = build_parser("Assembles and annotates the scFv constructs of many samples "
+                          "on a pool of worker processes")
+    parser.add_argument(
+        "--manifest",
+        required=True,
+        help=f"TSV with a {SAMPLE_COL} and a {DIRECTORY_COL} column, and optionally an "
+             f"{OUTPUT_COL} one; every directory holds the MiXCR exports of a sample, "
+             "processed there as assemble_annotate.py would (relative paths of the "
+             "options, like --output, are relative to it)"
+    )
+    parser.add_argument(
+        "--jobs",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="worker processes; each is started once and processes many samples, "
+             "with the cores split between them"
+    )
+    parser.add_argument(
+        "--batch-memory",
+        dest="batch_memory",
+        type=float,
+        help="GiB the samples running at once may use together, by the --estimate "
+             "model; no bound by default"
+    )
+    args = parser.parse_args()
+    if args.pairs_only or args.estimate:
+        parser.error("--pairs-only and --estimate are options of main.py")
+    check_pairing_args(parser, args)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.batch_memory is not None and args.pairs is not None:
+        parser.error("--batch-memory estimates from the alignment exports, which --pairs replaces")
+
+    try:
+        samples = read_manifest(args.manifest)
+    except ValueError as e:
+        parser.error(str(e))
+    errors = run_batch(args, samples)
+    failed = [sample for sample, error in errors.items() if error is not None]
+    if failed:
+        sys.exit(f"{len(failed)} of {len(errors)} samples failed: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+from typing import Optional
+
+import polars as pl
+
+# Ids are indexed directly as long as the position array stays within this
+# many slots per clone; sparser ids fall back to the hash join.
+MAX_SLOTS_PER_CLONE = 4
+
+
+class CloneIndex:
+    """Clone table addressed directly by cloneId.
+
+    MiXCR clone ids are dense integers (0..N-1, with gaps where clones were
+    filtered out on export), so a `position[cloneId] -> row` array replaces the
+    hash join: attributes are attached to the paired counts by positional gather.
+    """
+
+    def __init__(self, clones: pl.DataFrame, id_col: str = "cloneId"):
+        ids = clones.get_column(id_col)
+        self.id_col = id_col
+        self.table = clones.drop(id_col)
+        size = (ids.max() + 1) if len(ids) > 0 else 0
+        self.positions = pl.repeat(None, size, dtype=pl.UInt32, eager=True).scatter(
+            ids, pl.int_range(len(ids), dtype=pl.UInt32, eager=True))
+
+    @classmethod
+    def build(cls, clones: pl.DataFrame, id_col: str = "cloneId") -> Optional["CloneIndex"]:
+        """Index of the clone table, or None if its ids cannot be addressed directly."""
+        ids = clones.get_column(id_col)
+        if not ids.dtype.is_integer() or ids.null_count() > 0 or not ids.is_unique().all():
+            return None
+        if len(ids) > 0 and (ids.min() < 0 or ids.max() >= MAX_SLOTS_PER_CLONE * len(ids) + 1024):
+            return None
+        return cls(clones, id_col)
+
+    def gather(self, clone_ids: pl.Series) -> pl.DataFrame:
+        """Clone attributes for each id, in order; unknown ids give null rows."""
+        known = (clone_ids >= 0) & (clone_ids < len(self.positions))
+        rows = self.positions.gather(
+            pl.select(pl.when(known).then(clone_ids)).to_series())
+        return self.table.select(pl.all().gather(rows))
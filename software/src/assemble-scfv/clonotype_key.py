@@ -0,0 +1,62 @@
+import base64
+import hashlib
+
+import numpy as np
+import polars as pl
+
+# Keys are the first 12 bytes (24 hex digits) of the SHA-256 of the formatted
+# key, base32-encoded: 20 characters followed by "====" padding.
+DIGEST_BYTES = 12
+KEY_CHARS = 20
+KEY_PADDING = b"===="
+B32_ALPHABET = np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ234567", dtype=np.uint8)
+
+
+def hash_clonotype_key(key: str) -> str:
+    """Reference single-key implementation; stored clonotypeKey values depend on it."""
+    return base64.b32encode(bytes.fromhex(
+        hashlib.sha256(key.encode()).hexdigest()[:24])).decode("utf-8")
+
+
+def hash_clonotype_keys(keys: pl.Series) -> pl.Series:
+    """Hashes a column of formatted clonotype keys, identical to `hash_clonotype_key`.
+
+    Keys are digested in one pass (hashlib holds the GIL for keys this short,
+    so threads would not help) and base32-encoded in bulk; nulls stay null.
+    """
+    present = keys.drop_nulls()
+    if len(present) == 0:
+        return pl.repeat(None, len(keys), dtype=pl.String, eager=True).alias(keys.name)
+
+    sha256 = hashlib.sha256
+    digests = np.frombuffer(
+        b"".join([sha256(key.encode()).digest()[:DIGEST_BYTES] for key in present.to_list()]),
+        dtype=np.uint8).reshape(len(present), DIGEST_BYTES)
+
+    # base32 of the 96 bits and 4 zero bits: 20 quintets, read from a 64-bit and a
+    # (shifted) 32-bit big-endian word, one column at a time
+    high = digests[:, :8].copy().view(">u8").ravel().astype(np.uint64)
+    low = digests[:, 8:].copy().view(">u4").ravel().astype(np.uint64) << np.uint64(4)
+    out = np.empty((len(present), KEY_CHARS + len(KEY_PADDING) + 1), dtype=np.uint8)
+    for char in range(KEY_CHARS):
+        shift = 5 * (KEY_CHARS - 1 - char)  # of the quintet in the 100-bit value
+        if shift >= 36:
+            quintet = high >> np.uint64(shift - 36)
+        else:
+            quintet = (high << np.uint64(36 - shift)) | (low >> np.uint64(shift))
+        out[:, char] = B32_ALPHABET[quintet & np.uint64(31)]
+
+    # Every key is followed by a '\n' separator, used to split it back
+    out[:, KEY_CHARS:-1] = np.frombuffer(KEY_PADDING, dtype=np.uint8)
+    out[:, -1] = ord("\n")
+    hashed = pl.Series([out.tobytes()[:-1].decode()]).str.split("\n").explode()
+
+    if len(present) < len(keys):
+        hashed = pl.repeat(None, len(keys), dtype=pl.String, eager=True).scatter(
+            keys.is_not_null().arg_true(), hashed)
+    return hashed.alias(keys.name)
+
+
+def clonotype_key_expr(expr: pl.Expr) -> pl.Expr:
+    """Expression form of `hash_clonotype_keys`."""
+    return expr.map_batches(hash_clonotype_keys, return_dtype=pl.String, is_elementwise=True)
@@ -0,0 +1,381 @@
+import argparse
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import polars as pl
+
+from profiling import Profiler
+from tables import scan_table, write_table
+from translation import translate, translate_expr
+
+BASE36_DIGITS = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+BASE36_BYTES = np.frombuffer(BASE36_DIGITS.encode(), dtype=np.uint8)
+# A well-formed "code:start+length" segment; values with any other segment
+# go through the row-wise parser so that they behave exactly as before.
+SEGMENT_PATTERN = r"^(?P<code>[0-9A-Za-z_.\-]*):(?P<start>[0-9A-Za-z]+)\+(?P<length>[0-9A-Za-z]+)$"
+CONSTRUCT_ANNOTATION_COLS = [
+    "nAnnotationOfCDRsForConstruct",
+    "nAnnotationOfSegmentsForConstruct",
+    "aaAnnotationOfCDRsForConstruct",
+    "aaAnnotationOfSegmentsForConstruct",
+]
+
+
+def base36_encode(n: int) -> str:
+    if n == 0:
+        return "0"
+    if n < 0:
+        raise ValueError("base36_encode expects non-negative integers")
+    out = ""
+    while n > 0:
+        n, r = divmod(n, 36)
+        out = BASE36_DIGITS[r] + out
+    return out
+
+
+def base36_decode(s: str) -> Optional[int]:
+    if s is None:
+        return None
+    s = s.strip().upper()
+    if s == "":
+        return None
+    try:
+        return int(s, 36)
+    except ValueError:
+        return None
+
+
+def parse_segments(value: Optional[str]) -> List[Tuple[str, int, int]]:
+    if not value:
+        return []
+    segments: List[Tuple[str, int, int]] = []
+    for part in value.split("|"):
+        part = part.strip()
+        if not part:
+            continue
+        if ":" not in part or "+" not in part:
+            continue
+        code, rest = part.split(":", 1)
+        start_s, length_s = rest.split("+", 1)
+        start = base36_decode(start_s)
+        length = base36_decode(length_s)
+        if start is None or length is None:
+            continue
+        segments.append((code, start, length))
+    return segments
+
+
+def encode_segments(segments: Iterable[Tuple[str, int, int]]) -> str:
+    seen = set()
+    output: List[Tuple[int, str]] = []
+    for code, start, length in segments:
+        if length <= 0:
+            continue
+        key = (code, start, length)
+        if key in seen:
+            continue
+        seen.add(key)
+        output.append(
+            (start, f"{code}:{base36_encode(start)}+{base36_encode(length)}")
+        )
+    output.sort(key=lambda x: x[0])
+    return "|".join(item for _, item in output)
+
+
+def base36_encode_series(values: pl.Series) -> pl.Series:
+    """Column-wise `base36_encode`: the digits of every place are computed for
+    the whole column and looked up in one byte table."""
+    numbers = values.fill_null(0).cast(pl.Int64).to_numpy()
+    if len(numbers) == 0:
+        return pl.Series(values.name, [], dtype=pl.String)
+    if numbers.min() < 0:
+        raise ValueError("base36_encode expects non-negative integers")
+    # only the places of the largest value; positions rarely need more than 4
+    places = len(base36_encode(int(numbers.max())))
+    # one row per value, its places most significant first, then a '\n' separator
+    chars = np.empty((len(numbers), places + 1), dtype=np.uint8)
+    # the first kept place of every value; leading zeros are dropped, 0 is "0"
+    first = np.full(len(numbers), places - 1)
+    for place in range(places):
+        if place > 0:
+            first -= numbers > 0
+        numbers, digit = np.divmod(numbers, 36)
+        chars[:, places - 1 - place] = BASE36_BYTES[digit]
+    chars[:, places] = ord("\n")
+    keep = np.arange(places + 1) >= first[:, None]
+
+    text = chars[keep].tobytes()[:-1].decode()
+    encoded = pl.Series([text]).str.split("\n").explode()
+    return pl.select(
+        pl.when(values.is_null()).then(None).otherwise(encoded)
+    ).to_series().alias(values.name)
+
+
+def base36_encode_expr(expr: pl.Expr) -> pl.Expr:
+    """Expression form of `base36_encode_series`."""
+    return expr.map_batches(base36_encode_series, return_dtype=pl.String, is_elementwise=True)
+
+
+def shift_segments(
+    df: pl.DataFrame, sources: List[Tuple[str, pl.Expr]]
+) -> Tuple[pl.DataFrame, pl.Series]:
+    """Column-wise `parse_segments` + offset shift + `encode_segments`.
+
+    `sources` are (annotation column, offset expression) pairs in chain order.
+    Returns the encoded segments per `_row` (rows without segments are absent)
+    and the rows holding segments that are not well-formed.
+    """
+    parts = pl.concat([
+        df.select(
+            "_row",
+            offset.cast(pl.Int64).alias("_offset"),
+            pl.col(col).cast(pl.Utf8).str.split("|").alias("_part"),
+        ).explode("_part")
+        for col, offset in sources
+    ])
+    parts = parts.with_columns(pl.col("_part").str.strip_chars()).filter(
+        pl.col("_part").str.contains(":", literal=True)
+        & pl.col("_part").str.contains("+", literal=True)
+    )
+    parts = parts.with_columns(
+        pl.col("_part").str.extract_groups(SEGMENT_PATTERN).alias("_segment")
+    ).unnest("_segment").with_columns(
+        pl.col("start").str.to_integer(base=36, strict=False),
+        pl.col("length").str.to_integer(base=36, strict=False),
+    )
+
+    malformed = pl.col("start").is_null() | pl.col("length").is_null()
+    malformed_rows = parts.filter(malformed).get_column("_row").unique()
+
+    # Frame order is (chain, row, position in value): within a row, chain then
+    # position, the order in which the row-wise implementation dedupes and then
+    # stably sorts by start.
+    segments = (
+        parts.filter(~malformed)
+        .with_columns(pl.col("start") + pl.col("_offset"))
+        .filter(pl.col("length") > 0)
+        .unique(subset=["_row", "code", "start", "length"], keep="first", maintain_order=True)
+        .sort(["_row", "start"], maintain_order=True)
+        .with_columns(
+            _encoded=pl.format(
+                "{}:{}+{}",
+                "code",
+                base36_encode_expr(pl.col("start")),
+                base36_encode_expr(pl.col("length")),
+            )
+        )
+    )
+    encoded = segments.group_by("_row", maintain_order=True).agg(
+        pl.col("_encoded").str.join("|")
+    )
+    return encoded, malformed_rows
+
+
+def pick_col(columns: List[str], candidates: List[str]) -> Optional[str]:
+    for name in candidates:
+        if name in columns:
+            return name
+    return None
+
+
+def normalize_seq(value: Optional[str]) -> str:
+    if value is None:
+        return ""
+    return value.strip()
+
+
+def add_construct_annotations(
+    df: pl.DataFrame, order: str, linker: str, hinge: str
+) -> pl.DataFrame:
+    """Adds the *AnnotationOf*ForConstruct columns to a construct table."""
+    columns = df.columns
+
+    heavy_nt_col = pick_col(
+        columns, ["nSeqVDJRegion-IGHeavy", "nSeqImputedVDJRegion-IGHeavy"]
+    )
+    light_nt_col = pick_col(
+        columns, ["nSeqVDJRegion-IGLight", "nSeqImputedVDJRegion-IGLight"]
+    )
+    heavy_aa_col = pick_col(
+        columns, ["aaSeqVDJRegion-IGHeavy", "aaSeqImputedVDJRegion-IGHeavy"]
+    )
+    light_aa_col = pick_col(
+        columns, ["aaSeqVDJRegion-IGLight", "aaSeqImputedVDJRegion-IGLight"]
+    )
+
+    if heavy_nt_col is None:
+        raise ValueError("Missing heavy VDJ nt sequence column")
+    if light_nt_col is None:
+        raise ValueError("Missing light VDJ nt sequence column")
+
+    ann_cols = {
+        ("n", "CDRs", "IGHeavy"): "nAnnotationOfCDRsForVDJRegion-IGHeavy",
+        ("n", "Segments", "IGHeavy"): "nAnnotationOfSegmentsForVDJRegion-IGHeavy",
+        ("aa", "CDRs", "IGHeavy"): "aaAnnotationOfCDRsForVDJRegion-IGHeavy",
+        ("aa", "Segments", "IGHeavy"): "aaAnnotationOfSegmentsForVDJRegion-IGHeavy",
+        ("n", "CDRs", "IGLight"): "nAnnotationOfCDRsForVDJRegion-IGLight",
+        ("n", "Segments", "IGLight"): "nAnnotationOfSegmentsForVDJRegion-IGLight",
+        ("aa", "CDRs", "IGLight"): "aaAnnotationOfCDRsForVDJRegion-IGLight",
+        ("aa", "Segments", "IGLight"): "aaAnnotationOfSegmentsForVDJRegion-IGLight",
+    }
+
+    linker_nt = normalize_seq(linker)
+    hinge_nt = normalize_seq(hinge)
+    linker_aa = translate(linker_nt)
+    _ = hinge_nt  # hinge does not affect offsets (no annotations)
+
+    df = df.with_columns(
+        _heavy_nt=pl.col(heavy_nt_col).cast(pl.Utf8).fill_null("").str.strip_chars(),
+        _light_nt=pl.col(light_nt_col).cast(pl.Utf8).fill_null("").str.strip_chars(),
+    )
+
+    if heavy_aa_col:
+        df = df.with_columns(
+            _heavy_aa_raw=pl.col(heavy_aa_col).cast(pl.Utf8).fill_null("").str.strip_chars()
+        )
+    else:
+        df = df.with_columns(_heavy_aa_raw=pl.lit(""))
+
+    if light_aa_col:
+        df = df.with_columns(
+            _light_aa_raw=pl.col(light_aa_col).cast(pl.Utf8).fill_null("").str.strip_chars()
+        )
+    else:
+        df = df.with_columns(_light_aa_raw=pl.lit(""))
+
+    df = df.with_columns(
+        _heavy_aa=pl.when(pl.col("_heavy_aa_raw") == "")
+        .then(translate_expr(pl.col("_heavy_nt")))
+        .otherwise(pl.col("_heavy_aa_raw")),
+        _light_aa=pl.when(pl.col("_light_aa_raw") == "")
+        .then(translate_expr(pl.col("_light_nt")))
+        .otherwise(pl.col("_light_aa_raw")),
+    )
+
+    ann_input_cols = [
+        "_heavy_nt",
+        "_light_nt",
+        "_heavy_aa",
+        "_light_aa",
+    ]
+    present_ann_cols = {
+        k: v for k, v in ann_cols.items() if v in columns
+    }
+    ann_input_cols += list({v for v in present_ann_cols.values()})
+
+    # Row-wise reference implementation, applied only to rows with segments that
+    # are not well-formed (see SEGMENT_PATTERN); other rows are shifted column-wise.
+    def build_construct_annotations(row: Dict[str, str]) -> Dict[str, str]:
+        heavy_nt = normalize_seq(row.get("_heavy_nt"))
+        light_nt = normalize_seq(row.get("_light_nt"))
+        heavy_aa = normalize_seq(row.get("_heavy_aa"))
+        light_aa = normalize_seq(row.get("_light_aa"))
+
+        if order == "hl":
+            nt_offsets = {"IGHeavy": 0, "IGLight": len(heavy_nt) + len(linker_nt)}
+            aa_offsets = {"IGHeavy": 0, "IGLight": len(heavy_aa) + len(linker_aa)}
+        else:
+            nt_offsets = {"IGLight": 0, "IGHeavy": len(light_nt) + len(linker_nt)}
+            aa_offsets = {"IGLight": 0, "IGHeavy": len(light_aa) + len(linker_aa)}
+
+        out: Dict[str, str] = {
+            "nAnnotationOfCDRsForConstruct": "",
+            "nAnnotationOfSegmentsForConstruct": "",
+            "aaAnnotationOfCDRsForConstruct": "",
+            "aaAnnotationOfSegmentsForConstruct": "",
+        }
+        for alphabet in ("n", "aa"):
+            for ann_type in ("CDRs", "Segments"):
+                segs: List[Tuple[str, int, int]] = []
+                for chain in ("IGHeavy", "IGLight"):
+                    col_name = present_ann_cols.get((alphabet, ann_type, chain))
+                    if not col_name:
+                        continue
+                    offset = nt_offsets[chain] if alphabet == "n" else aa_offsets[chain]
+                    for code, start, length in parse_segments(row.get(col_name)):
+                        segs.append((code, start + offset, length))
+                out_name = f"{alphabet}AnnotationOf{ann_type}ForConstruct"
+                out[out_name] = encode_segments(segs)
+        return out
+
+    if order == "hl":
+        first_nt, first_aa, second = "_heavy_nt", "_heavy_aa", "IGLight"
+    else:
+        first_nt, first_aa, second = "_light_nt", "_light_aa", "IGHeavy"
+    offsets = {
+        (alphabet, chain): pl.lit(0)
+        for alphabet in ("n", "aa") for chain in ("IGHeavy", "IGLight")
+    }
+    offsets[("n", second)] = pl.col(first_nt).str.len_chars() + len(linker_nt)
+    offsets[("aa", second)] = pl.col(first_aa).str.len_chars() + len(linker_aa)
+
+    df = df.with_row_index("_row")
+    malformed_rows = []
+    for alphabet in ("n", "aa"):
+        for ann_type in ("CDRs", "Segments"):
+            out_name = f"{alphabet}AnnotationOf{ann_type}ForConstruct"
+            sources = [
+                (present_ann_cols[(alphabet, ann_type, chain)], offsets[(alphabet, chain)])
+                for chain in ("IGHeavy", "IGLight")
+                if (alphabet, ann_type, chain) in present_ann_cols
+            ]
+            if not sources:
+                df = df.with_columns(pl.lit("").alias(out_name))
+                continue
+            encoded, malformed = shift_segments(df, sources)
+            malformed_rows.append(malformed)
+            df = df.join(
+                encoded.rename({"_encoded": out_name}), on="_row", how="left", maintain_order="left"
+            ).with_columns(pl.col(out_name).fill_null(""))
+
+    malformed = pl.concat(malformed_rows).unique() if malformed_rows else pl.Series([], dtype=pl.UInt32)
+    if len(malformed) > 0:
+        fallback = df.filter(pl.col("_row").is_in(malformed.implode())).select(
+            "_row",
+            pl.struct(ann_input_cols).map_elements(
+                build_construct_annotations,
+                return_dtype=pl.Struct(
+                    [pl.Field(name, pl.Utf8) for name in CONSTRUCT_ANNOTATION_COLS]
+                ),
+            ).alias("_ann"),
+        ).unnest("_ann")
+        df = df.update(fallback, on="_row")
+
+    return df.drop(
+        ["_row", "_heavy_nt", "_light_nt", "_heavy_aa_raw", "_light_aa_raw", "_heavy_aa", "_light_aa"]
+    )
+
+
+def main() -> None:
+    p = argparse.ArgumentParser(
+        description="Build scFv construct annotation columns from heavy/light annotations"
+    )
+    p.add_argument(
+        "--input", "--input_tsv", dest="input", required=True,
+        help="Input table path (.tsv, .parquet or .arrow)")
+    p.add_argument(
+        "--output", "--output_tsv", dest="output", required=True,
+        help="Output table path (.tsv, .parquet or .arrow)")
+    p.add_argument("--order", required=True, choices=["hl", "lh"])
+    p.add_argument("--linker", required=True, help="Linker nt sequence")
+    p.add_argument("--hinge", required=True, help="Hinge nt sequence")
+    p.add_argument(
+        "--profile-json", dest="profile_json",
+        help="Write per-stage wall time, CPU time, row counts and peak RSS to this JSON file")
+    args = p.parse_args()
+
+    profiler = Profiler(args.profile_json)
+    with profiler.measure("read", input=args.input) as record:
+        df = scan_table(args.input).collect()
+        record["rows_out"] = df.height
+    with profiler.measure("construct annotations", df.height) as record:
+        df = add_construct_annotations(df, args.order, args.linker, args.hinge)
+        record["rows_out"] = df.height
+    with profiler.measure("write", df.height, output=args.output) as record:
+        write_table(df, args.output)
+        record["rows_out"] = df.height
+    profiler.write()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+from itertools import combinations
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+
+# Segments of a sequence, as text (seeds) and as integers (mismatch counting)
+Segments = Tuple[Tuple[str, ...], Tuple[int, ...]]
+
+
+class SeedIndex:
+    """Sequences of one length, found by exact seeds within a Hamming distance.
+
+    Every sequence is cut into `distance + 2` segments. Two sequences within
+    `distance` mismatches differ in at most `distance` segments, so they share
+    at least one pair of segments exactly: a pair is a seed, and every pair is
+    indexed. Seeds span a large part of the sequence, so constructs sharing
+    only a chain (heavy or light) rarely meet as candidates.
+    """
+
+    def __init__(self, length: int, distance: int):
+        self.distance = distance
+        count = distance + 2
+        bounds = [length * i // count for i in range(count + 1)]
+        self.segments = list(zip(bounds[:-1], bounds[1:]))
+        self.seeds = list(combinations(range(count), 2))
+        # hash of a seed -> indexed sequences; hash collisions only add candidates
+        self.index: Dict[int, List[int]] = {}
+        self.entries: List[Tuple[int, Segments]] = []
+        # 0x01 in every byte of a segment, see _mismatches
+        self.masks = [int.from_bytes(b"\x01" * (end - start), "big") for start, end in self.segments]
+
+    def split(self, seq: str) -> Segments:
+        """The segments of a sequence, as text and as big-endian integers."""
+        parts = tuple(seq[start:end] for start, end in self.segments)
+        return parts, tuple(int.from_bytes(part.encode(), "big") for part in parts)
+
+    def _seed_hashes(self, parts: Tuple[str, ...]) -> List[int]:
+        return [hash((i, j, parts[i], parts[j])) for i, j in self.seeds]
+
+    def add(self, item: int, segments: Segments) -> None:
+        entry = len(self.entries)
+        self.entries.append((item, segments))
+        for seed in self._seed_hashes(segments[0]):
+            self.index.setdefault(seed, []).append(entry)
+
+    def nearest(self, segments: Segments) -> int:
+        """The first added item within the distance of `segments`, or -1."""
+        candidates = set()
+        for seed in self._seed_hashes(segments[0]):
+            candidates.update(self.index.get(seed, ()))
+        for entry in sorted(candidates):
+            item, other = self.entries[entry]
+            if self._within(segments[1], other[1]):
+                return item
+        return -1
+
+    def _within(self, codes: Tuple[int, ...], other: Tuple[int, ...]) -> bool:
+        mismatches = 0
+        for a, b, mask in zip(codes, other, self.masks):
+            if a != b:
+                mismatches += _mismatches(a ^ b, mask)
+                if mismatches > self.distance:
+                    return False
+        return True
+
+
+def _mismatches(diff: int, mask: int) -> int:
+    """Nonzero bytes of `diff`: every byte is folded onto its lowest bit."""
+    diff |= diff >> 4
+    diff |= diff >> 2
+    diff |= diff >> 1
+    return (diff & mask).bit_count()
+
+
+def collapse_parents(
+    sequences: Sequence[str],
+    abundances: np.ndarray,
+    distance: int,
+    ratio: float
+) -> np.ndarray:
+    """Parent row of every sequence: the most abundant sequence of the same
+    length within `distance` mismatches that is at least `ratio` times as
+    abundant, or the row itself.
+
+    Sequences are visited abundance-descending and only those left as parents
+    are indexed, so a sequence merges into a parent and never into another
+    merged sequence.
+    """
+    abundances = np.asarray(abundances, dtype=np.float64)
+    # abundance-descending, ties by sequence so the result does not depend on row order
+    values = abundances.tolist()
+    order = sorted(range(len(sequences)), key=lambda row: (-values[row], sequences[row]))
+    parents = np.arange(len(sequences), dtype=np.int64)
+    indexes: Dict[int, SeedIndex] = {}
+    top = abundances[order[0]] if order else 0
+    for row in order:
+        seq = sequences[row]
+        index = indexes.get(len(seq))
+        if index is None:
+            index = indexes[len(seq)] = SeedIndex(len(seq), distance)
+        segments = index.split(seq)
+        # rows abundant enough that no parent can be `ratio` times larger skip the search
+        if abundances[row] * ratio <= top:
+            parent = index.nearest(segments)
+            if parent >= 0 and abundances[parent] >= ratio * abundances[row]:
+                parents[row] = parent
+                continue
+        index.add(row, segments)
+    return parents
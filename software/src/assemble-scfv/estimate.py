@@ -0,0 +1,100 @@
+import math
+from typing import Dict, Optional
+
+import polars as pl
+
+from pairing import READ_ID_COL
+from tables import input_compression, scan_table, tsv_batches, uncompressed_size
+
+# Rows read from the head of each alignments export to extrapolate from
+SAMPLE_ROWS = 100_000
+
+# Peak RSS (MiB) ~ BASE + PER_ALIGNMENT_MIB * alignments MiB + PER_CLONE_MIB * clones MiB,
+# least-squares fit of `assemble-annotate --engine streaming --read-id-key hash`
+# on the software/bench datasets (1e4-6e6 reads, 1e3-2e5 clones), within +-15%.
+# Sizes are uncompressed; polars decompresses a compressed input whole before
+# scanning it, which adds PER_DECOMPRESSED_MIB per uncompressed MiB.
+BASE_MIB = 144
+PER_ALIGNMENT_MIB = 9.7
+PER_CLONE_MIB = 8.6
+PER_DECOMPRESSED_MIB = 1.0
+# Requested memory = prediction with this margin, rounded up to whole GiB
+MEMORY_MARGIN = 1.25
+# One thread per this many MiB of input, within [1, MAX_THREADS]; polars gains
+# little beyond that on this workload
+MIB_PER_THREAD = 128
+MAX_THREADS = 8
+
+
+def sample_alignments(path: str) -> Dict[str, object]:
+    """Row count, distinct cloneIds, read id width and UMI presence of an alignments
+    export, extrapolated from its first SAMPLE_ROWS rows by (uncompressed) byte size."""
+    size = uncompressed_size(path)
+    batches = []
+    for batch in tsv_batches(path):
+        batches.append(batch)
+        if sum(batch.height for batch in batches) >= SAMPLE_ROWS:
+            break
+    sample = pl.concat(batches).head(SAMPLE_ROWS)
+    columns = sample.columns
+    # bytes per row as written: values, separators and the newline
+    line_bytes = sample.select(
+        pl.sum_horizontal(pl.all().str.len_bytes().fill_null(0)).sum()
+    ).item() + sample.height * len(columns)
+    header_bytes = len("\t".join(columns)) + 1
+
+    if sample.height < SAMPLE_ROWS:
+        rows = sample.height
+    else:
+        rows = round((size - header_bytes) * sample.height / max(line_bytes, 1))
+    assigned = sample.filter(pl.col("cloneId") != "-1")
+    return {
+        "bytes": size,
+        "compressed": input_compression(path) is not None,
+        "rows": rows,
+        "rowsExact": sample.height < SAMPLE_ROWS,
+        "assignedFraction": round(assigned.height / max(sample.height, 1), 4),
+        "distinctCloneIdsInSample": assigned.get_column("cloneId").n_unique(),
+        "meanReadIdWidth": round(sample.get_column(READ_ID_COL).str.len_bytes().mean() or 0, 1),
+        "umi": any(col.startswith("tagValueUMI") for col in columns),
+    }
+
+
+def count_clones(path: str) -> Dict[str, object]:
+    return {
+        "bytes": uncompressed_size(path),
+        "compressed": input_compression(path) is not None,
+        "rows": scan_table(path).select(pl.len()).collect().item(),
+    }
+
+
+def estimate(
+    hc_clones: str,
+    hc_alignments: str,
+    lc_clones: Optional[str] = None,
+    lc_alignments: Optional[str] = None
+) -> Dict[str, object]:
+    """Predicted peak memory and a recommended thread count for assembling these inputs."""
+    alignment_paths = [hc_alignments] + ([lc_alignments] if lc_alignments else [])
+    clone_paths = [hc_clones] + ([lc_clones] if lc_clones else [])
+    alignments = {path: sample_alignments(path) for path in alignment_paths}
+    clones = {path: count_clones(path) for path in clone_paths}
+
+    alignments_mib = sum(v["bytes"] for v in alignments.values()) / 2 ** 20
+    clones_mib = sum(v["bytes"] for v in clones.values()) / 2 ** 20
+    decompressed_mib = sum(v["bytes"] for v in (*alignments.values(), *clones.values())
+                           if v["compressed"]) / 2 ** 20
+    peak_mib = BASE_MIB + PER_ALIGNMENT_MIB * alignments_mib + PER_CLONE_MIB * clones_mib \
+        + PER_DECOMPRESSED_MIB * decompressed_mib
+
+    return {
+        "alignments": alignments,
+        "clones": clones,
+        "alignmentRows": sum(v["rows"] for v in alignments.values()),
+        "cloneRows": sum(v["rows"] for v in clones.values()),
+        "umi": any(v["umi"] for v in alignments.values()),
+        "predictedPeakMemoryGiB": round(peak_mib / 1024, 2),
+        "recommendedMemoryGiB": max(1, math.ceil(peak_mib * MEMORY_MARGIN / 1024)),
+        "recommendedThreads": min(MAX_THREADS, max(1, math.ceil(
+            (alignments_mib + clones_mib) / MIB_PER_THREAD))),
+    }
@@ -1,314 +1,691 @@
-import polars as pl
 import argparse
-import hashlib
-import base64
-
-parser = argparse.ArgumentParser(
-    description="Assembles scFv from MiXCR alignments"
-)
-parser.add_argument("--linker", help="linker nt sequence")
-parser.add_argument("--hinge", help="hinge nt sequence")
-parser.add_argument(
-    "--order",
-    help="construct building order: hl for 'heavy-linker-light-hinge' or lh for 'light-linker-heavy-hinge'")
-parser.add_argument(
-    "--light-impute",
-    dest="light_impute",
-    help="optional light chain VDJ sequence to use when light is missing"
-)
-parser.add_argument(
-    "--no-light",
-    action="store_true",
-    help="do not expect light chain mixcr inputs; use --light-impute"
-)
-args = parser.parse_args()
-
-
-linker = args.linker
-hinge = args.hinge
-
-
-prefix = ""  # "test_data/"
-hc_clones_file = prefix + "hc.clones.tsv"
-lc_clones_file = prefix + "lc.clones.tsv"
-
-hc_alignments_file = prefix + "hc.alignments.tsv"
-lc_alignments_file = prefix + "lc.alignments.tsv"
-
-schema_overrides = {
-    "nLengthCDR3": pl.String,
-    "aaLengthCDR3": pl.String
-}
-
-hc_mixcr_clones = pl.read_csv(
-    hc_clones_file, separator="\t", infer_schema_length=0)
-hc_mixcr_clones = hc_mixcr_clones.with_columns(
-    pl.col("cloneId").cast(pl.Int64))
-# Remove "InFrame" from all column names in hc_mixcr_clones DataFrame
-hc_mixcr_clones = hc_mixcr_clones.rename(
-    {col: col.replace("InFrame", "") for col in hc_mixcr_clones.columns})
-
-if not args.no_light:
-    lc_mixcr_clones = pl.read_csv(
-        lc_clones_file, separator="\t", infer_schema_length=0)
-    lc_mixcr_clones = lc_mixcr_clones.with_columns(
-        pl.col("cloneId").cast(pl.Int64))
-    # Remove "InFrame" from all column names in lc_mixcr_clones DataFrame
-    lc_mixcr_clones = lc_mixcr_clones.rename(
-        {col: col.replace("InFrame", "") for col in lc_mixcr_clones.columns})
-
-
-cols_to_drop = ['readCount', 'readFraction',
-                'uniqueMoleculeCount', 'uniqueMoleculeFraction']
-hc_mixcr_clones = hc_mixcr_clones.drop(
-    [col for col in cols_to_drop if col in hc_mixcr_clones.columns])
-if not args.no_light:
-    lc_mixcr_clones = lc_mixcr_clones.drop(
-        [col for col in cols_to_drop if col in lc_mixcr_clones.columns])
-
-hc_mixcr_alignments = pl.read_csv(
-    hc_alignments_file, separator="\t", infer_schema_length=0)
-hc_mixcr_alignments = hc_mixcr_alignments.with_columns(
-    pl.col("cloneId").cast(pl.Int64))
-if not args.no_light:
-    lc_mixcr_alignments = pl.read_csv(
-        lc_alignments_file, separator="\t", infer_schema_length=0)
-    lc_mixcr_alignments = lc_mixcr_alignments.with_columns(
-        pl.col("cloneId").cast(pl.Int64))
-
-hc_mixcr_alignments = hc_mixcr_alignments.filter(pl.col('cloneId') != -1)
-if not args.no_light:
-    lc_mixcr_alignments = lc_mixcr_alignments.filter(pl.col('cloneId') != -1)
-
-
-hc_cols = {
-    col: f"{col}-IGHeavy" for col in hc_mixcr_alignments.columns if col != "descrR1"}
-if not args.no_light:
-    lc_cols = {
-        col: f"{col}-IGLight" for col in lc_mixcr_alignments.columns if col != "descrR1"}
-else:
-    lc_cols = {}
-if not args.no_light:
-    hl = hc_mixcr_alignments.rename(hc_cols).join(
-        lc_mixcr_alignments.rename(lc_cols),
-        on="descrR1",
-        how="inner"
-    )
-else:
-    # fabricate a single synthetic light cloneId to cross with heavy cloneId and preserve heavy aggregation
-    hl = hc_mixcr_alignments.rename(hc_cols).with_columns(
-        **{"cloneId-IGLight": pl.lit(0)}
-    )
+import json
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
 
-# Identify all molecular-barcode (UMI) tag columns exported by MiXCR.
-# It will most probably be one, but we safely handle more
-umi_cols = [c for c in hl.columns
-            if c.startswith('tagValueUMI') and c.endswith('-IGHeavy')]
+import polars as pl
+
+from clone_index import CloneIndex
+from clonotype_key import clonotype_key_expr
+from construct_collapse import collapse_parents
+from estimate import estimate
+from pairing import (CLONE_ID_COL, READ_ID_KEYS, UMI_COUNTS, alignments_digest, assigned_alignments,
+                     collect_pairs, pair_alignments, pair_alignments_partitioned, paired_clones, read_clone_map, scan_alignments,
+                     scan_pairs, top_up_pairs, without_umi_sets, write_pairs)
+from pairing_diagnostics import write_pairing_diagnostics
+from profiling import DISABLED, Profiler
+from tables import input_path, read_header, scan_table, sink_table, table_format
+from translation import STOP_CODONS, replace_stop_codons, stop_codon_code, translate_expr
+
+HC_CLONES_FILE = "hc.clones.tsv"
+LC_CLONES_FILE = "lc.clones.tsv"
+HC_ALIGNMENTS_FILE = "hc.alignments.tsv"
+LC_ALIGNMENTS_FILE = "lc.alignments.tsv"
+RESULT_FILE = "result.tsv"
+
+# Abundance columns of the per-chain clone tables; they are replaced by the
+# paired read/UMI counts and never reach the output.
+CLONE_ABUNDANCE_COLS = [
+    "readCount",
+    "readFraction",
+    "uniqueMoleculeCount",
+    "uniqueMoleculeFraction",
+]
 
-if umi_cols:
-    hl = hl.group_by(['cloneId-IGHeavy', 'cloneId-IGLight']).agg(
-        readCount=pl.col('descrR1').count(),
-        umiCount=pl.struct(umi_cols).n_unique()
+INTERMEDIATE_COUNT_COLS = ["readCount", "umiCount"]
+INTERMEDIATE_FRACTION_COLS = ["readFraction", "umiFraction"]
+# Row of the first construct of every construct-aa group in the final aggregation
+REPRESENTATIVE_COL = "_representative"
+# Abundance column ordering the constructs for --collapse-distance, if present,
+# else readCount
+COLLAPSE_ABUNDANCE_COL = "umiCount"
+# Added with --stop-codon-replacements: whether any amino acid column of a row
+# had a stop replaced, and which ones (comma-separated)
+STOP_CODON_REPLACED_COL = "stopCodonReplaced"
+STOP_CODON_REPLACED_COLUMNS_COL = "stopCodonReplacedColumns"
+GENE_COLUMN = re.compile(r"^best[VDJC](Gene|Hit|Family)-IG(Heavy|Light)$")
+
+
+def build_parser(description: str = "Assembles scFv from MiXCR alignments") -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--linker", help="linker nt sequence")
+    parser.add_argument("--hinge", help="hinge nt sequence")
+    parser.add_argument(
+        "--order",
+        help="construct building order: hl for 'heavy-linker-light-hinge' or lh for 'light-linker-heavy-hinge'")
+    parser.add_argument(
+        "--light-impute",
+        dest="light_impute",
+        help="optional light chain VDJ sequence to use when light is missing"
     )
-    hl = hl.with_columns(
-        (pl.col('umiCount') / pl.col('umiCount').sum()).alias('umiFraction'))
-else:
-    hl = hl.group_by([
-        'cloneId-IGHeavy',
-        'cloneId-IGLight'
-    ]).agg(readCount=pl.count())
-
-hl = hl.with_columns(
-    (pl.col('readCount') / pl.col('readCount').sum()).alias('readFraction'))
-
-# heavy
-hc_mixcr_clones = hc_mixcr_clones.rename(
-    {col: f"{col}-IGHeavy" for col in hc_mixcr_clones.columns})
-result = hl.join(hc_mixcr_clones,
-                 on='cloneId-IGHeavy',
-                 how='left')
-
-if not args.no_light:
-    # light
-    lc_mixcr_clones = lc_mixcr_clones.rename(
-        {col: f"{col}-IGLight" for col in lc_mixcr_clones.columns})
-    result = result.join(lc_mixcr_clones,
-                        on='cloneId-IGLight',
-                        how='left')
-
-if not args.no_light:
-    result = result.with_columns(
-        clonotypeKey=pl.format("{}-{}-{}-{}-{}-{}",
-                               "targetSequences-IGHeavy", "targetSequences-IGLight",
-                               "bestVGene-IGHeavy", "bestVGene-IGLight",
-                               "bestJGene-IGHeavy", "bestJGene-IGLight")
+    parser.add_argument(
+        "--no-light",
+        action="store_true",
+        help="do not expect light chain mixcr inputs; use --light-impute"
     )
-else:
-    # no light info; construct key using only heavy-side fields and a sentinel light part
-    result = result.with_columns(
-        clonotypeKey=pl.format("{}-{}-{}",
-                               "targetSequences-IGHeavy",
-                               "bestVGene-IGHeavy",
-                               "bestJGene-IGHeavy")
+    parser.add_argument(
+        "--output",
+        default=RESULT_FILE,
+        help="output table; a .parquet or .arrow extension writes a typed, "
+             "zstd-compressed intermediate instead of TSV, a .tsv.zst or .tsv.gz "
+             "extension a compressed TSV"
     )
-
-result = result.filter(pl.col('clonotypeKey').is_not_null())
-
-
-if "bestCGene-IGHeavy" in result.columns and "bestCGene-IGLight" in result.columns:
-    result = result.with_columns(
-        clonotypeKey=pl.col("clonotypeKey") + "-" +
-        result["bestCGene-IGHeavy"] + "-" + result["bestCGene-IGLight"]
+    parser.add_argument(
+        "--read-id-key",
+        dest="read_id_key",
+        choices=READ_ID_KEYS,
+        default="string",
+        help="how heavy and light reads are matched: 'string' joins on the full "
+             "descrR1 header, 'hash' on a 128-bit hash of it (two independent "
+             "64-bit hashes), which is much smaller on deep samples"
     )
-
-# Hash the clonotypeKey after potentially adding C-genes
-result = result.with_columns(
-    clonotypeKey=pl.col('clonotypeKey').map_elements(
-        lambda x: base64.b32encode(bytes.fromhex(
-            hashlib.sha256(x.encode()).hexdigest()[:24])).decode('utf-8'),
-        return_dtype=pl.String
+    parser.add_argument(
+        "--umi-count",
+        dest="umi_count",
+        choices=UMI_COUNTS,
+        default="exact",
+        help="how distinct UMIs are counted per clone pair: 'exact' on integer-encoded "
+             "UMIs, or 'approximate' with a HyperLogLog sketch (about 1%% error) for "
+             "huge samples"
     )
-)
-
-result = result.with_columns(
-    clonotypeLabel="C-" + pl.col("clonotypeKey").str.slice(0, 6))
-
-heavyVdj = None
-lightVdj = None
-
-if "nSeqVDJRegion-IGHeavy" in result.columns:
-    heavyVdj = "nSeqVDJRegion-IGHeavy"
-elif "nSeqImputedVDJRegion-IGHeavy" in result.columns:
-    heavyVdj = "nSeqImputedVDJRegion-IGHeavy"
-else:
-    raise ValueError("VDJ region - heavy not found")
-
-if "nSeqVDJRegion-IGLight" in result.columns:
-    lightVdj = "nSeqVDJRegion-IGLight"
-elif "nSeqImputedVDJRegion-IGLight" in result.columns:
-    lightVdj = "nSeqImputedVDJRegion-IGLight"
-elif args.light_impute is not None:
-    # Create a synthetic light VDJ column from provided impute sequence
-    result = result.with_columns(
-        **{"nSeqImputedVDJRegion-IGLight": pl.lit(args.light_impute)}
+    parser.add_argument(
+        "--max-memory",
+        dest="max_memory",
+        type=float,
+        help="memory budget in GiB for heavy/light pairing; when set, reads are "
+             "spilled to disk in buckets by read id and paired bucket by bucket"
     )
-    lightVdj = "nSeqImputedVDJRegion-IGLight"
-else:
-    raise ValueError("VDJ region - light not found and no --light-impute provided")
-
-
-# Filter out rows where VDJ regions are empty/null or contain region_not_covered
-result = result.filter(
-    (pl.col(heavyVdj).is_not_null()) &
-    (pl.col(heavyVdj).str.len_chars() > 0) &
-    (~pl.col(heavyVdj).str.contains('region_not_covered')) &
-    (pl.col(lightVdj).is_not_null()) &
-    (pl.col(lightVdj).str.len_chars() > 0) &
-    (~pl.col(lightVdj).str.contains('region_not_covered'))
-)
-
-# Create construct-nt column
-if args.order == "hl":
-    result = result.with_columns(
-        (pl.col(heavyVdj) + linker + pl.col(lightVdj) + hinge).alias("construct-nt"))
-elif args.order == "lh":
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        help="number of pairing buckets; derived from --max-memory by default"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="processes pairing buckets concurrently (with --max-memory)"
+    )
+    parser.add_argument(
+        "--stop-codon-replacements",
+        dest="stop_codon_replacements",
+        type=parse_stop_codon_replacements,
+        help="comma-separated stop type=amino acid pairs, e.g. amber=Q,opal=W (types: "
+             + ", ".join(STOP_CODONS) + "; '*' keeps the stop); the stops of construct-aa "
+             "and of the aaSeq* columns are replaced, and stopCodonReplaced / "
+             "stopCodonReplacedColumns columns are added"
+    )
+    parser.add_argument(
+        "--collapse-distance",
+        dest="collapse_distance",
+        type=parse_collapse_distance,
+        help="merge every construct into a more abundant one whose construct-aa has "
+             "the same length and at most this many mismatches (see --collapse-ratio), "
+             "summing the counts; absorbs sequencing errors of long constructs"
+    )
+    parser.add_argument(
+        "--collapse-ratio",
+        dest="collapse_ratio",
+        type=parse_collapse_ratio,
+        default=5.0,
+        help="with --collapse-distance, how many times more abundant (UMIs, else "
+             "reads) the construct merged into must be"
+    )
+    parser.add_argument(
+        "--sort-by-key",
+        dest="sort_by_key",
+        action="store_true",
+        help="sort the output by clonotypeKey instead of construct-nt, as "
+             "aggregate_samples.py expects its inputs"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["in-memory", "streaming"],
+        default="in-memory",
+        help="polars engine used to execute the lazy query; 'streaming' processes "
+             "the inputs in batches and keeps peak memory bounded on deep samples"
+    )
+    parser.add_argument(
+        "--profile-json",
+        dest="profile_json",
+        help="write per-stage wall time, CPU time, row counts and peak RSS to this "
+             "JSON file; stages are then executed one by one"
+    )
+    parser.add_argument(
+        "--pairs",
+        help="pairing table written by --pairs-output; used instead of the alignment "
+             "exports, which are then not needed"
+    )
+    parser.add_argument(
+        "--pairs-output",
+        dest="pairs_output",
+        help="also write the pairing table (cloneId-IGHeavy, cloneId-IGLight, readCount, "
+             "umiCount) to this parquet file"
+    )
+    parser.add_argument(
+        "--pairs-umi-sets",
+        dest="pairs_umi_sets",
+        action="store_true",
+        help="keep the distinct UMIs of every clone pair in the --pairs-output / "
+             "--pairs-cache table, so that a later --top-up run can merge into it"
+    )
+    parser.add_argument(
+        "--top-up",
+        dest="top_up",
+        help="pairing table of earlier reads of the library (--pairs-output, with "
+             "--pairs-umi-sets if there are UMIs); the alignment exports then hold only "
+             "the new reads, which are paired and merged into it, with the same result "
+             "as pairing all reads at once"
+    )
+    parser.add_argument(
+        "--clone-map",
+        dest="clone_map",
+        help="with --top-up, a TSV with chain (IGHeavy / IGLight), previousCloneId and "
+             "cloneId columns giving the current cloneId of every clone of the --top-up "
+             "table (-1 drops it); a chain it does not list keeps its cloneIds"
+    )
+    parser.add_argument(
+        "--pairs-cache",
+        dest="pairs_cache",
+        help="directory of pairing tables keyed by a content hash of the alignment "
+             "exports; a table found there is reused, a computed one is stored"
+    )
+    parser.add_argument(
+        "--pairing-report-json",
+        dest="pairing_report_json",
+        help="write pairing diagnostics to this JSON file: reads paired, of one chain "
+             "only, not assigned to a clone (cloneId -1) or on several alignments of "
+             "a chain, and how unambiguously the clones pair; computed in the pairing "
+             "join, so a --pairs-cache table is then not reused"
+    )
+    parser.add_argument(
+        "--pairing-clones-tsv",
+        dest="pairing_clones_tsv",
+        help="write the pairing of every heavy and light clone to this TSV: paired "
+             "reads, reads with the other chain absent or unassigned, partner clones "
+             "and the share of the top partner"
+    )
+    parser.add_argument(
+        "--pairs-only",
+        dest="pairs_only",
+        action="store_true",
+        help="stop after pairing (with --pairs-output or --pairs-cache)"
+    )
+    parser.add_argument(
+        "--estimate",
+        action="store_true",
+        help="only scan the inputs and print the predicted peak memory and a "
+             "recommended thread count as JSON"
+    )
+    return parser
+
+
+def parse_stop_codon_replacements(value: str) -> Dict[str, str]:
+    replacements = {}
+    for item in value.split(","):
+        stop_type, _, aa = item.strip().partition("=")
+        aa = aa.strip().upper()
+        if stop_type not in STOP_CODONS:
+            raise argparse.ArgumentTypeError(
+                f"unknown stop codon type {stop_type!r}, expected one of {', '.join(STOP_CODONS)}")
+        if not re.fullmatch(r"[A-Z*]", aa):
+            raise argparse.ArgumentTypeError(
+                f"replacement of {stop_type} must be one amino acid letter or '*', got {aa!r}")
+        replacements[stop_type] = aa
+    return replacements
+
+
+def parse_collapse_distance(value: str) -> int:
+    distance = int(value)
+    if distance < 1:
+        raise argparse.ArgumentTypeError(f"collapse distance must be at least 1, got {distance}")
+    return distance
+
+
+def parse_collapse_ratio(value: str) -> float:
+    ratio = float(value)
+    if not ratio >= 1:
+        raise argparse.ArgumentTypeError(f"collapse ratio must be at least 1, got {value}")
+    return ratio
+
+
+def clone_columns(path: str) -> Dict[str, pl.DataType]:
+    """The columns of a clone export the output carries, by its header, with
+    their dtypes: cloneId is parsed, the others are kept as exported."""
+    header = read_header(path)
+    if CLONE_ID_COL not in header:
+        raise ValueError(f"{path} lacks column {CLONE_ID_COL}")
+    return {col: pl.Int64 if col == CLONE_ID_COL else pl.String
+            for col in header if col not in CLONE_ABUNDANCE_COLS}
+
+
+def scan_clones(path: str) -> pl.LazyFrame:
+    columns = clone_columns(path)
+    clones = scan_table(path, schema_overrides=columns).select(list(columns))
+    # Remove "InFrame" from all column names
+    return clones.rename({col: col.replace("InFrame", "") for col in columns})
+
+
+def attach_clones(
+    hl: pl.LazyFrame,
+    hc_clones: pl.LazyFrame,
+    lc_clones: Optional[pl.LazyFrame],
+    engine: str = "auto"
+) -> pl.LazyFrame:
+    """Adds the heavy and light clone attributes to the clone pairs.
+
+    Attributes are gathered by position through a direct cloneId index; tables
+    whose ids cannot be indexed (duplicated or negative) are hash-joined instead.
+    """
+    # The pair table is small (one row per clone pair), it is materialized once
+    result = hl.collect(engine=engine)
+    chains = [("IGHeavy", hc_clones)]
+    if lc_clones is not None:
+        chains.append(("IGLight", lc_clones))
+
+    for chain, clones in chains:
+        clones = clones.rename(
+            {col: f"{col}-{chain}" for col in clones.collect_schema().names()}
+        ).collect(engine=engine)
+        id_col = f"cloneId-{chain}"
+        index = CloneIndex.build(clones, id_col)
+        if index is None:
+            result = result.join(clones, on=id_col, how='left')
+        else:
+            result = result.hstack(index.gather(result.get_column(id_col)).get_columns())
+    return result.lazy()
+
+
+def add_clonotype_key(result: pl.LazyFrame, no_light: bool) -> pl.LazyFrame:
+    if not no_light:
+        result = result.with_columns(
+            clonotypeKey=pl.format("{}-{}-{}-{}-{}-{}",
+                                   "targetSequences-IGHeavy", "targetSequences-IGLight",
+                                   "bestVGene-IGHeavy", "bestVGene-IGLight",
+                                   "bestJGene-IGHeavy", "bestJGene-IGLight")
+        )
+    else:
+        # no light info; construct key using only heavy-side fields and a sentinel light part
+        result = result.with_columns(
+            clonotypeKey=pl.format("{}-{}-{}",
+                                   "targetSequences-IGHeavy",
+                                   "bestVGene-IGHeavy",
+                                   "bestJGene-IGHeavy")
+        )
+
+    result = result.filter(pl.col('clonotypeKey').is_not_null())
+
+    columns = result.collect_schema().names()
+    if "bestCGene-IGHeavy" in columns and "bestCGene-IGLight" in columns:
+        result = result.with_columns(
+            clonotypeKey=pl.col("clonotypeKey") + "-" +
+            pl.col("bestCGene-IGHeavy") + "-" + pl.col("bestCGene-IGLight")
+        )
+
+    # Hash the clonotypeKey after potentially adding C-genes
     result = result.with_columns(
-        (pl.col(lightVdj) + linker + pl.col(heavyVdj) + hinge).alias("construct-nt"))
-else:
-    raise ValueError("Invalid order: " + args.order)
-
-# Translate nucleotide sequence to amino acid sequence
-
-
-def translate(seq):
-    if seq is None:
-        return None
-
-    # Standard genetic code
-    genetic_code = {
-        'ATA': 'I', 'ATC': 'I', 'ATT': 'I', 'ATG': 'M',
-        'ACA': 'T', 'ACC': 'T', 'ACG': 'T', 'ACT': 'T',
-        'AAC': 'N', 'AAT': 'N', 'AAA': 'K', 'AAG': 'K',
-        'AGC': 'S', 'AGT': 'S', 'AGA': 'R', 'AGG': 'R',
-        'CTA': 'L', 'CTC': 'L', 'CTG': 'L', 'CTT': 'L',
-        'CCA': 'P', 'CCC': 'P', 'CCG': 'P', 'CCT': 'P',
-        'CAC': 'H', 'CAT': 'H', 'CAA': 'Q', 'CAG': 'Q',
-        'CGA': 'R', 'CGC': 'R', 'CGG': 'R', 'CGT': 'R',
-        'GTA': 'V', 'GTC': 'V', 'GTG': 'V', 'GTT': 'V',
-        'GCA': 'A', 'GCC': 'A', 'GCG': 'A', 'GCT': 'A',
-        'GAC': 'D', 'GAT': 'D', 'GAA': 'E', 'GAG': 'E',
-        'GGA': 'G', 'GGC': 'G', 'GGG': 'G', 'GGT': 'G',
-        'TCA': 'S', 'TCC': 'S', 'TCG': 'S', 'TCT': 'S',
-        'TTC': 'F', 'TTT': 'F', 'TTA': 'L', 'TTG': 'L',
-        'TAC': 'Y', 'TAT': 'Y', 'TAA': '*', 'TAG': '*',
-        'TGC': 'C', 'TGT': 'C', 'TGA': '*', 'TGG': 'W',
-    }
-
-    protein = ""
-    # Read in codons (3 nucleotides at a time)
-    for i in range(0, len(seq), 3):
-        codon = seq[i:i+3].upper()
-        # Skip if incomplete codon
-        if len(codon) < 3:
-            continue
-        # Translate codon to amino acid
-        aa = genetic_code.get(codon, 'X')  # X for unknown codons
-        protein += aa
-
-    # Add underscore if sequence length is not divisible by 3
-    if len(seq) % 3 != 0:
-        protein += '_'
-
-    return protein
-
-
-# Add amino acid sequence column
-result = result.with_columns(pl.col("construct-nt").map_elements(
-    translate, return_dtype=pl.String).alias("construct-aa"))
-
-# isProductive: use MiXCR's reading-frame-aware AA sequences, which correctly
-# detect internal frameshifts (e.g. CDR3 N-nucleotide additions) that a naive
-# codon-by-codon translation would miss.
-heavy_aa_col = heavyVdj.replace("nSeq", "aaSeq")
-
-if args.no_light:
-    # Light chain is synthetic/imputed — no MiXCR AA column exists for it.
-    # Productivity is determined by the heavy chain alone.
-    is_productive_expr = ~pl.col(heavy_aa_col).str.contains(r"[*_]", strict=False)
-else:
-    light_aa_col = lightVdj.replace("nSeq", "aaSeq")
-    is_productive_expr = (
-        ~pl.col(heavy_aa_col).str.contains(r"[*_]", strict=False)
-        & ~pl.col(light_aa_col).str.contains(r"[*_]", strict=False)
+        clonotypeKey=clonotype_key_expr(pl.col('clonotypeKey'))
     )
 
-result = result.with_columns(
-    isProductive=is_productive_expr
-)
-
-# Group by 'construct-aa' and aggregate
-# Sum readCount and readFraction, take first value for all other columns
-agg_expressions = [
-    pl.sum('readCount'),
-    pl.sum('readFraction')
-]
-if 'umiCount' in result.columns:
-    agg_expressions.append(pl.sum('umiCount'))
-    agg_expressions.append(pl.sum('umiFraction'))
-
-
-# Create a list of expressions for all other columns to take the first value
-other_cols = [col for col in result.columns if col not in [
-    'construct-aa', 'readCount', 'readFraction', 'umiCount', 'umiFraction']]
-agg_expressions.extend([pl.first(col) for col in other_cols])
-
-# Perform the groupby operation
-result = result.group_by('construct-aa').agg(agg_expressions)
+    return result.with_columns(
+        clonotypeLabel="C-" + pl.col("clonotypeKey").str.slice(0, 6))
+
+
+def build_constructs(
+    result: pl.LazyFrame,
+    order: str,
+    linker: str,
+    hinge: str,
+    light_impute: Optional[str],
+    no_light: bool,
+    profiler: Profiler = DISABLED
+) -> pl.LazyFrame:
+    columns = result.collect_schema().names()
+
+    if "nSeqVDJRegion-IGHeavy" in columns:
+        heavyVdj = "nSeqVDJRegion-IGHeavy"
+    elif "nSeqImputedVDJRegion-IGHeavy" in columns:
+        heavyVdj = "nSeqImputedVDJRegion-IGHeavy"
+    else:
+        raise ValueError("VDJ region - heavy not found")
+
+    if "nSeqVDJRegion-IGLight" in columns:
+        lightVdj = "nSeqVDJRegion-IGLight"
+    elif "nSeqImputedVDJRegion-IGLight" in columns:
+        lightVdj = "nSeqImputedVDJRegion-IGLight"
+    elif light_impute is not None:
+        # Create a synthetic light VDJ column from provided impute sequence
+        result = result.with_columns(
+            **{"nSeqImputedVDJRegion-IGLight": pl.lit(light_impute)}
+        )
+        lightVdj = "nSeqImputedVDJRegion-IGLight"
+    else:
+        raise ValueError("VDJ region - light not found and no --light-impute provided")
+
+    # Filter out rows where VDJ regions are empty/null or contain region_not_covered
+    result = result.filter(
+        (pl.col(heavyVdj).is_not_null()) &
+        (pl.col(heavyVdj).str.len_chars() > 0) &
+        (~pl.col(heavyVdj).str.contains('region_not_covered')) &
+        (pl.col(lightVdj).is_not_null()) &
+        (pl.col(lightVdj).str.len_chars() > 0) &
+        (~pl.col(lightVdj).str.contains('region_not_covered'))
+    )
+    result = profiler.stage("VDJ filter", result)
+
+    # Create construct-nt column
+    if order == "hl":
+        result = result.with_columns(
+            (pl.col(heavyVdj) + linker + pl.col(lightVdj) + hinge).alias("construct-nt"))
+    elif order == "lh":
+        result = result.with_columns(
+            (pl.col(lightVdj) + linker + pl.col(heavyVdj) + hinge).alias("construct-nt"))
+    else:
+        raise ValueError("Invalid order: " + str(order))
+
+    # Add amino acid sequence column
+    result = result.with_columns(
+        translate_expr(pl.col("construct-nt")).alias("construct-aa"))
+
+    # isProductive: use MiXCR's reading-frame-aware AA sequences, which correctly
+    # detect internal frameshifts (e.g. CDR3 N-nucleotide additions) that a naive
+    # codon-by-codon translation would miss.
+    heavy_aa_col = heavyVdj.replace("nSeq", "aaSeq")
+
+    if no_light:
+        # Light chain is synthetic/imputed — no MiXCR AA column exists for it.
+        # Productivity is determined by the heavy chain alone.
+        is_productive_expr = ~pl.col(heavy_aa_col).str.contains(r"[*_]", strict=False)
+    else:
+        light_aa_col = lightVdj.replace("nSeq", "aaSeq")
+        is_productive_expr = (
+            ~pl.col(heavy_aa_col).str.contains(r"[*_]", strict=False)
+            & ~pl.col(light_aa_col).str.contains(r"[*_]", strict=False)
+        )
+
+    return profiler.stage("translation", result.with_columns(
+        isProductive=is_productive_expr
+    ))
+
+
+def aggregate_constructs(
+    result: pl.LazyFrame,
+    profiler: Profiler = DISABLED,
+    engine: str = "auto",
+    sort_col: str = "construct-nt"
+) -> pl.LazyFrame:
+    """Merges the constructs with the same construct-aa, sorted by `sort_col`
+    (construct-nt, or clonotypeKey for the cross-sample merge).
+
+    Counts and fractions are summed on a narrow table that keeps only the row
+    of the first construct of every group; the attribute columns of those rows
+    are then gathered once, already in output order.
+    """
+    columns = result.collect_schema().names()
+
+    # Sum readCount and readFraction (and the UMI ones), take the first row for all other columns
+    count_cols = ['readCount', 'readFraction']
+    if 'umiCount' in columns:
+        count_cols += ['umiCount', 'umiFraction']
+    other_cols = [col for col in columns if col not in ['construct-aa'] + count_cols]
+
+    # The construct table is materialized once, its wide columns stay out of the group_by
+    constructs = result.collect(engine=engine)
+    # ties of another sort column are broken by construct-nt
+    sort_cols = list(dict.fromkeys([sort_col, 'construct-nt']))
+    groups = constructs.lazy().select(['construct-aa'] + sort_cols + count_cols) \
+        .with_row_index(REPRESENTATIVE_COL) \
+        .group_by('construct-aa') \
+        .agg([pl.sum(col) for col in count_cols] + [pl.first(REPRESENTATIVE_COL)] + [pl.first(col) for col in sort_cols])
+    groups = profiler.stage("final group_by", groups)
+
+    groups = profiler.stage("sort", groups.sort(sort_cols)).collect(engine=engine)
+    with profiler.measure("gather", groups.height) as record:
+        result = groups.select(['construct-aa'] + count_cols).hstack(
+            constructs.select(pl.col(other_cols).gather(groups.get_column(REPRESENTATIVE_COL))).get_columns())
+        record["rows_out"] = result.height
+
+    # Normalize isProductive to lowercase string values "true"/"false"
+    return result.lazy().with_columns(
+        pl.col("isProductive").cast(pl.Utf8).str.to_lowercase().alias("isProductive")
+    )
 
-result = result.sort("construct-nt")
 
-# Normalize isProductive to lowercase string values "true"/"false"
-result = result.with_columns(
-    pl.col("isProductive").cast(pl.Utf8).str.to_lowercase().alias("isProductive")
-)
-result.write_csv("result.tsv", separator="\t")
+def collapse_constructs(
+    result: pl.LazyFrame,
+    distance: int,
+    ratio: float,
+    profiler: Profiler = DISABLED,
+    engine: str = "auto"
+) -> pl.LazyFrame:
+    """Merges constructs into more abundant ones with a near-identical
+    construct-aa (see `collapse_parents`), keeping the row order and the
+    attributes of the constructs merged into and summing the counts."""
+    columns = result.collect_schema().names()
+    count_cols = [col for col in INTERMEDIATE_COUNT_COLS + INTERMEDIATE_FRACTION_COLS if col in columns]
+    abundance_col = COLLAPSE_ABUNDANCE_COL if COLLAPSE_ABUNDANCE_COL in columns else "readCount"
+
+    constructs = result.collect(engine=engine)
+    with profiler.measure("construct collapse", constructs.height) as record:
+        parents = pl.Series(collapse_parents(
+            constructs.get_column("construct-aa").to_list(),
+            constructs.get_column(abundance_col).to_numpy(),
+            distance, ratio))
+        sums = constructs.select(count_cols).with_columns(_parent=parents) \
+            .group_by("_parent").agg(pl.sum(col) for col in count_cols).sort("_parent")
+        result = constructs.filter(parents == pl.int_range(len(parents), eager=True)) \
+            .with_columns(sums.get_columns()[1:])
+        record["rows_out"] = result.height
+    return result.lazy()
+
+
+def apply_stop_codon_replacements(result: pl.LazyFrame, replacements: Dict[str, str]) -> pl.LazyFrame:
+    """Replaces stops in construct-aa and every aaSeq* column with an nSeq*
+    counterpart, translating the nucleotide columns in one pass."""
+    columns = result.collect_schema().names()
+    pairs = {"construct-aa": "construct-nt"}
+    pairs.update({col: col.replace("aaSeq", "nSeq", 1) for col in columns if col.startswith("aaSeq")})
+    pairs = {aa: nt for aa, nt in pairs.items() if aa in columns and nt in columns}
+    code = stop_codon_code(replacements)
+
+    def replaced(aa: str, nt: str) -> pl.Expr:
+        return pl.struct(aa, nt).map_batches(
+            lambda s: replace_stop_codons(s.struct.field(aa), s.struct.field(nt), code),
+            return_dtype=pl.String, is_elementwise=True)
+
+    result = result.with_columns(replaced(aa, nt).alias("_" + aa) for aa, nt in pairs.items())
+    changed = [pl.col("_" + aa).ne_missing(pl.col(aa)) for aa in pairs]
+    return result.with_columns(
+        pl.any_horizontal(changed or [pl.lit(False)]).alias(STOP_CODON_REPLACED_COL),
+        pl.concat_str([pl.when(c).then(pl.lit(aa)) for c, aa in zip(changed, pairs)] or [pl.lit("")],
+                      separator=",", ignore_nulls=True).alias(STOP_CODON_REPLACED_COLUMNS_COL),
+        *(pl.col("_" + aa).alias(aa) for aa in pairs),
+    ).drop("_" + aa for aa in pairs)
+
+
+def with_intermediate_dtypes(result: pl.LazyFrame) -> pl.LazyFrame:
+    """Declared dtypes of the columnar intermediate; other columns stay String."""
+    casts = []
+    for col in result.collect_schema().names():
+        if col.startswith("cloneId-"):
+            casts.append(pl.col(col).cast(pl.Int64))
+        elif col in INTERMEDIATE_COUNT_COLS:
+            casts.append(pl.col(col).cast(pl.UInt32))
+        elif col in INTERMEDIATE_FRACTION_COLS:
+            casts.append(pl.col(col).cast(pl.Float64))
+        elif GENE_COLUMN.match(col):
+            casts.append(pl.col(col).cast(pl.Categorical))
+    return result.with_columns(casts)
+
+
+def read_alignments(path: str, profiler: Profiler = DISABLED, unassigned: bool = False) -> pl.LazyFrame:
+    alignments = profiler.stage("read", scan_alignments(path, unassigned=True), inputs=[], input=path)
+    if unassigned:
+        return alignments
+    return profiler.stage("filter", assigned_alignments(alignments), input=path)
+
+
+def pairing_diagnostics(args: argparse.Namespace) -> bool:
+    return args.pairing_report_json is not None or args.pairing_clones_tsv is not None
+
+
+def check_pairing_args(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    """Rejects pairing options that cannot be combined."""
+    if args.pairs is not None and pairing_diagnostics(args):
+        parser.error("pairing diagnostics are computed from the alignment exports, which --pairs replaces")
+    if args.top_up is not None and args.pairs is not None:
+        parser.error("--top-up merges new alignment exports into a pairing table, --pairs replaces them")
+    if args.top_up is not None and args.pairs_cache is not None:
+        parser.error("--pairs-cache keys the pairing of the alignment exports alone, not of a --top-up")
+    if args.clone_map is not None and args.top_up is None:
+        parser.error("--clone-map maps the cloneIds of a --top-up table")
+    if (args.pairs_umi_sets or args.top_up is not None) and args.umi_count != "exact":
+        parser.error("UMI sets (--pairs-umi-sets, --top-up) need --umi-count exact")
+
+
+def alignment_files(no_light: bool) -> List[str]:
+    """The alignment exports present, plain or compressed (.zst, .gz)."""
+    files = [HC_ALIGNMENTS_FILE] if no_light else [HC_ALIGNMENTS_FILE, LC_ALIGNMENTS_FILE]
+    return [input_path(path) for path in files]
+
+
+def clone_files(no_light: bool) -> List[str]:
+    """The clone exports present, plain or compressed (.zst, .gz)."""
+    files = [HC_CLONES_FILE] if no_light else [HC_CLONES_FILE, LC_CLONES_FILE]
+    return [input_path(path) for path in files]
+
+
+def pair_reads(args: argparse.Namespace, profiler: Profiler = DISABLED) -> pl.LazyFrame:
+    """Pairing table: given with --pairs, found in --pairs-cache, or computed
+    from the alignment exports (always, with pairing diagnostics), and merged
+    into the --top-up table. It has UMI sets with --pairs-umi-sets or --top-up.
+    The table is returned collected (see `collect_pairs`)."""
+    diagnostics = pairing_diagnostics(args)
+    umi_sets = args.pairs_umi_sets or args.top_up is not None
+    if args.pairs is not None:
+        return collect_pairs(
+            profiler.stage("read", scan_pairs(args.pairs), inputs=[], input=args.pairs), args.engine).lazy()
+
+    outputs = [args.pairs_output] if args.pairs_output else []
+    if args.pairs_cache is not None:
+        with profiler.measure("alignments digest"):
+            digest = alignments_digest(
+                alignment_files(args.no_light), args.no_light, args.umi_count, args.pairs_umi_sets)
+        cached = os.path.join(args.pairs_cache, digest + ".parquet")
+        if os.path.exists(cached) and not diagnostics:
+            df = collect_pairs(profiler.stage("read", scan_pairs(cached), inputs=[], input=cached), args.engine)
+            if outputs:
+                write_pairs(df, outputs[0], args.pairs_umi_sets)
+            return df.lazy()
+        os.makedirs(args.pairs_cache, exist_ok=True)
+        outputs.append(cached)
+
+    if args.max_memory is not None:
+        # runs eagerly (spill, bucket joins, merge), so it is measured as a whole
+        alignment_paths = alignment_files(args.no_light)
+        with profiler.measure("partitioned pairing") as record:
+            hl = pair_alignments_partitioned(
+                alignment_paths[0], None if args.no_light else alignment_paths[1], args.read_id_key,
+                args.max_memory, args.partitions, args.workers, args.umi_count, diagnostics, umi_sets)
+            record["rows_out"] = profiler.count(hl)
+    else:
+        alignment_paths = alignment_files(args.no_light)
+        hc_alignments = read_alignments(alignment_paths[0], profiler, diagnostics)
+        lc_alignments: Optional[pl.LazyFrame] = None
+        if not args.no_light:
+            lc_alignments = read_alignments(alignment_paths[1], profiler, diagnostics)
+        hl = pair_alignments(
+            hc_alignments, lc_alignments, args.read_id_key, profiler, args.umi_count, diagnostics, umi_sets)
+
+    if diagnostics:
+        # one row per clone pair, plus the unpaired and unassigned reads per clone
+        cells = hl.collect(engine=args.engine)
+        with profiler.measure("pairing diagnostics", cells.height):
+            write_pairing_diagnostics(
+                cells, args.no_light, args.pairing_report_json, args.pairing_clones_tsv)
+        hl = paired_clones(cells.lazy())
+
+    if args.top_up is not None:
+        with profiler.measure("top-up merge", input=args.top_up) as record:
+            clone_map = read_clone_map(args.clone_map) if args.clone_map is not None else None
+            hl = collect_pairs(top_up_pairs(args.top_up, hl, clone_map), args.engine).lazy()
+            record["rows_out"] = profiler.count(hl)
+
+    # the pairing table is small (one row per clone pair)
+    df = collect_pairs(hl, args.engine)
+    for path in outputs:
+        write_pairs(df, path, args.pairs_umi_sets)
+    return df.lazy()
+
+
+def assemble(args: argparse.Namespace, profiler: Profiler = DISABLED) -> pl.LazyFrame:
+    """Builds the lazy query producing the scFv construct table."""
+    clone_paths = clone_files(args.no_light)
+    if profiler.enabled:
+        # stages are measured one at a time
+        hl = without_umi_sets(pair_reads(args, profiler))
+        clones = [profiler.stage("read", scan_clones(path), inputs=[], input=path)
+                  for path in clone_paths]
+    else:
+        # the clone exports are read on threads while the alignment exports
+        # (themselves read side by side by the pairing query) are paired
+        with ThreadPoolExecutor(max_workers=len(clone_paths)) as pool:
+            reading = [pool.submit(lambda path: scan_clones(path).collect(engine=args.engine), path)
+                       for path in clone_paths]
+            hl = without_umi_sets(pair_reads(args, profiler)).collect(engine=args.engine).lazy()
+            clones = [future.result().lazy() for future in reading]
+    hc_clones = clones[0]
+    lc_clones: Optional[pl.LazyFrame] = clones[1] if len(clones) > 1 else None
+
+    with profiler.measure("clone join", profiler.count(hl) if profiler.enabled else None) as record:
+        result = attach_clones(hl, hc_clones, lc_clones, args.engine)
+        record["rows_out"] = profiler.count(result)
+    result = profiler.stage("key hashing", add_clonotype_key(result, args.no_light))
+    result = build_constructs(
+        result, args.order, args.linker, args.hinge, args.light_impute, args.no_light, profiler)
+    result = aggregate_constructs(
+        result, profiler, args.engine, "clonotypeKey" if args.sort_by_key else "construct-nt")
+    if args.collapse_distance is not None:
+        result = collapse_constructs(
+            result, args.collapse_distance, args.collapse_ratio, profiler, args.engine)
+    if args.stop_codon_replacements:
+        result = profiler.stage(
+            "stop codon replacement", apply_stop_codon_replacements(result, args.stop_codon_replacements))
+    return result
+
+
+def main() -> None:
+    parser = build_parser()
+    args = parser.parse_args()
+    if args.estimate:
+        clone_paths = clone_files(args.no_light)
+        alignment_paths = alignment_files(args.no_light)
+        if args.no_light:
+            report = estimate(clone_paths[0], alignment_paths[0])
+        else:
+            report = estimate(clone_paths[0], alignment_paths[0], clone_paths[1], alignment_paths[1])
+        print(json.dumps(report, indent=2))
+        return
+
+    profiler = Profiler(args.profile_json, args.engine)
+    check_pairing_args(parser, args)
+    if args.pairs_only:
+        if not args.pairs_output and not args.pairs_cache:
+            parser.error("--pairs-only needs --pairs-output or --pairs-cache")
+        pair_reads(args, profiler)
+        profiler.write()
+        return
+
+    result = assemble(args, profiler)
+    if table_format(args.output) != "tsv":
+        result = with_intermediate_dtypes(result)
+    with profiler.measure("write", profiler.rows, output=args.output) as record:
+        sink_table(result, args.output, engine=args.engine)
+        record["rows_out"] = profiler.rows
+    profiler.write()
+
+
+if __name__ == "__main__":
+    main()
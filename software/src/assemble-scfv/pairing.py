@@ -0,0 +1,631 @@
+import glob
+import hashlib
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import polars as pl
+
+from profiling import DISABLED, Profiler
+from tables import read_header, scan_table, tsv_batches, uncompressed_size
+
+READ_ID_COL = "descrR1"
+CLONE_ID_COL = "cloneId"
+# Molecular barcode columns (tagValueUMI, or one per UMI tag)
+UMI_COL_PREFIX = "tagValueUMI"
+READ_ID_KEYS = ["string", "hash"]
+# Two independent 64-bit hashes make a 128-bit key: the chance of a collision
+# among 1e8 reads is ~1e-23, so pairing is the same as on the full header.
+READ_ID_HASH_COLS = ["readIdHash1", "readIdHash2"]
+READ_ID_HASH_SEEDS = [0x5CF1, 0xA11C]
+PAIR_COLS = ["cloneId-IGHeavy", "cloneId-IGLight"]
+
+# UMIs are deduplicated as u64 keys: ACGT-only UMIs of up to 31 bases are 2-bit
+# packed behind a leading 1 (exact, below 2^63); others (N, IUPAC, lower case,
+# longer) are hashed with the top bit set, so the two never meet. The keys are
+# stored in UMI sets, so they do not come from polars hashes, which may change
+# between polars versions: the hash is an 8-byte keyed BLAKE2b, and the keys of
+# several UMI captures are mixed into one with splitmix64 (a missing capture is
+# 0, which no key is).
+UMI_HASH_KEY = b"tagValueUMI"
+UMI_HASH_BIT = 1 << 63
+# Seed of the in-run hashes of UMI tuples for approximate counts
+UMI_HASH_SEED = 0x0D1
+UMI_COUNTS = ["exact", "approximate"]
+
+# Partitioned (out-of-core) pairing: reads are spilled to disk in buckets by
+# read id, so that heavy and light records of a read land in the same bucket.
+BUCKET_COL = "readIdBucket"
+BUCKET_SEED = 0xB0C4
+# The read counts and UMIs a read bucket finds are spilled again, in buckets by
+# clone pair, so that every pair is merged from one bucket rather than the sample
+PAIR_BUCKET_COL = "pairBucket"
+PAIR_BUCKET_SEED = 0xB0C5
+# Rough peak memory of joining a bucket, per byte of its alignments TSV
+MEMORY_PER_INPUT_BYTE = 4
+# Rows read from an alignments TSV between two spills
+SPILL_ROWS = 1_000_000
+
+# The pairing table depends on the alignment exports only; it is stored without
+# fractions and cached under a digest of their content. The version is part of
+# the digest and must be bumped whenever the pairing changes its result.
+PAIR_TABLE_COLS = PAIR_COLS + ["readCount", "umiCount"]
+FRACTION_COLS = ["readFraction", "umiFraction"]
+PAIR_TABLE_VERSION = 2
+DIGEST_CHUNK_BYTES = 1 << 20
+
+# With UMI sets, the pairing table also keeps the distinct UMIs of every clone
+# pair (a u64 key per UMI tuple, sorted), so that a later run on new reads of
+# the library can merge into it (see `top_up_pairs`); umiCount is their number.
+UMI_SET_COL = "umiSet"
+# Parquet metadata key of the UMI key scheme of a table with UMI sets; a top-up
+# refuses to unite sets of another scheme, whose keys would not match
+UMI_KEY_SCHEME_KEY = "umiKeyScheme"
+UMI_KEY_SCHEME = "2bit+blake2b64+splitmix64"
+# Clone-identity mapping of a top-up run: the cloneId, in the clone exports of
+# the run, of every cloneId of the previous pairing table, per chain (-1 drops
+# the clone)
+CLONE_MAP_CHAIN_COL = "chain"
+CLONE_MAP_PREVIOUS_COL = "previousCloneId"
+CLONE_MAP_CLONE_COL = "cloneId"
+
+# With pairing diagnostics, reads are joined keeping the unpaired (the missing
+# chain's cloneId is null) and the unassigned (cloneId -1) alignments, and every
+# clone pair counts its reads whose id is on several alignments of a chain,
+# each such read spread evenly over its alignments. Every read also counts once
+# in DISTINCT_READS_COL, at its row with the best states of the chains (see
+# `distinct_reads_expr`), so that read totals do not depend on the ambiguity.
+AMBIGUOUS_READS_COL = "ambiguousReads"
+DISTINCT_READS_COL = "distinctReads"
+DIAGNOSTICS_COLS = [AMBIGUOUS_READS_COL, DISTINCT_READS_COL]
+
+
+def assigned_alignments(alignments: pl.LazyFrame) -> pl.LazyFrame:
+    return alignments.filter(pl.col(CLONE_ID_COL) != -1)
+
+
+def alignment_columns(path: str) -> Dict[str, pl.DataType]:
+    """The columns of an alignments export that pairing reads, by its header,
+    with their dtypes; other exported columns are never parsed."""
+    header = read_header(path)
+    missing = [col for col in (CLONE_ID_COL, READ_ID_COL) if col not in header]
+    if missing:
+        raise ValueError(f"{path} lacks column(s) {', '.join(missing)}")
+    return {
+        col: pl.Int64 if col == CLONE_ID_COL else pl.String
+        for col in header if col in (CLONE_ID_COL, READ_ID_COL) or col.startswith(UMI_COL_PREFIX)
+    }
+
+
+def scan_alignments(path: str, unassigned: bool = False) -> pl.LazyFrame:
+    """The pairing columns of an alignments export; the reads of no clone
+    only if `unassigned`."""
+    columns = alignment_columns(path)
+    alignments = scan_table(path, schema_overrides=columns).select(list(columns))
+    # Not assigned reads are filtered right at the scan (predicate pushdown)
+    return alignments if unassigned else assigned_alignments(alignments)
+
+
+def encode_read_ids(
+    alignments: pl.LazyFrame, read_id_key: str
+) -> Tuple[pl.LazyFrame, List[str]]:
+    """Replaces descrR1 with the columns reads are joined on."""
+    if read_id_key == "string":
+        return alignments, [READ_ID_COL]
+    if read_id_key != "hash":
+        raise ValueError("Invalid read id key: " + str(read_id_key))
+    read_id = pl.col(READ_ID_COL)
+    # reads without an id never pair, as with the string join
+    return alignments.with_columns(
+        pl.when(read_id.is_not_null()).then(read_id.hash(seed=seed)).alias(col)
+        for col, seed in zip(READ_ID_HASH_COLS, READ_ID_HASH_SEEDS)
+    ).drop(READ_ID_COL), READ_ID_HASH_COLS
+
+
+def encode_umis(alignments: pl.LazyFrame) -> pl.LazyFrame:
+    """Replaces the tagValueUMI* strings with integer keys, one per distinct UMI."""
+    umi_cols = [col for col in alignments.collect_schema().names() if col.startswith(UMI_COL_PREFIX)]
+    if not umi_cols:
+        return alignments
+    # base-4 digits; anything else, or an Int64 overflow, does not parse
+    packed = alignments.with_columns(
+        (pl.lit("1") + pl.col(col).str.replace_many(["A", "C", "G", "T"], ["0", "1", "2", "3"])
+         ).str.to_integer(base=4, strict=False).cast(pl.UInt64).alias(col + "-packed")
+        for col in umi_cols)
+    # only the UMIs that do not pack reach the hash; packing in a step of its
+    # own keeps it from being computed twice
+    return packed.with_columns(
+        pl.coalesce(col + "-packed", pl.when(pl.col(col + "-packed").is_null()).then(pl.col(col)).map_batches(
+            hash_umis, return_dtype=pl.UInt64, is_elementwise=True)).alias(col)
+        for col in umi_cols
+    ).drop([col + "-packed" for col in umi_cols])
+
+
+def hash_umis(umis: pl.Series) -> pl.Series:
+    """u64 keys of a String column of UMIs: keyed 8-byte BLAKE2b digests with
+    the top bit set; nulls stay null."""
+    present = umis.drop_nulls()
+    if len(present) == 0:
+        return pl.repeat(None, len(umis), dtype=pl.UInt64, eager=True).alias(umis.name)
+    blake2b = hashlib.blake2b
+    digests = np.frombuffer(b"".join([
+        blake2b(umi.encode(), digest_size=8, key=UMI_HASH_KEY).digest() for umi in present.to_list()
+    ]), dtype="<u8") | np.uint64(UMI_HASH_BIT)
+    hashed = pl.Series(umis.name, digests, dtype=pl.UInt64)
+    if len(present) < len(umis):
+        hashed = pl.repeat(None, len(umis), dtype=pl.UInt64, eager=True).scatter(
+            umis.is_not_null().arg_true(), hashed)
+    return hashed.alias(umis.name)
+
+
+def splitmix64(x: np.ndarray) -> np.ndarray:
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def combine_umis(umis: pl.Series) -> pl.Series:
+    """One u64 key per row of a Struct of u64 UMI keys (one field per capture)."""
+    key = np.zeros(len(umis), dtype=np.uint64)
+    for field in umis.struct.fields:
+        key = splitmix64(key ^ umis.struct.field(field).fill_null(0).to_numpy())
+    return pl.Series(umis.name, key, dtype=pl.UInt64)
+
+
+def umi_count_expr(umi_cols: List[str], umi_count: str = "exact") -> pl.Expr:
+    """Distinct UMIs (tuples of all UMI captures) of a group."""
+    umis = pl.col(umi_cols[0]) if len(umi_cols) == 1 else pl.struct(umi_cols)
+    if umi_count == "exact":
+        return umis.n_unique()
+    if umi_count != "approximate":
+        raise ValueError("Invalid UMI count: " + str(umi_count))
+    # HyperLogLog sketch per group instead of a hash set of every UMI
+    if len(umi_cols) > 1:
+        umis = umis.hash(seed=UMI_HASH_SEED)
+    return umis.approx_n_unique().cast(pl.UInt32)
+
+
+def umi_set_expr(umi_cols: List[str]) -> pl.Expr:
+    """Distinct UMIs of a group as a sorted list of u64 keys; several UMI
+    captures are combined into one key (see `combine_umis`)."""
+    if len(umi_cols) == 1:
+        return pl.col(umi_cols[0]).unique().sort()
+    # elementwise, so it runs once on the column rather than once per group
+    return pl.struct(umi_cols).map_batches(
+        combine_umis, return_dtype=pl.UInt64, is_elementwise=True).unique().sort()
+
+
+def with_umi_set_counts(hl: pl.LazyFrame) -> pl.LazyFrame:
+    return hl.with_columns(umiCount=pl.col(UMI_SET_COL).list.len())
+
+
+def umi_columns(hl: pl.LazyFrame) -> List[str]:
+    # Identify all molecular-barcode (UMI) tag columns exported by MiXCR.
+    # It will most probably be one, but we safely handle more
+    return [c for c in hl.collect_schema().names()
+            if c.startswith(UMI_COL_PREFIX) and c.endswith('-IGHeavy')]
+
+
+def join_reads(
+    hc_alignments: pl.LazyFrame,
+    lc_alignments: Optional[pl.LazyFrame],
+    key_cols: List[str],
+    how: str = "inner"
+) -> pl.LazyFrame:
+    """One row per read, with the heavy and light alignment columns suffixed;
+    `how="full"` keeps the reads of one chain only."""
+    hc_cols = {
+        col: f"{col}-IGHeavy"
+        for col in hc_alignments.collect_schema().names() if col not in key_cols}
+    if lc_alignments is None:
+        # fabricate a single synthetic light cloneId to cross with heavy cloneId and preserve heavy aggregation
+        return hc_alignments.rename(hc_cols).with_columns(
+            **{"cloneId-IGLight": pl.lit(0)}
+        )
+    lc_cols = {
+        col: f"{col}-IGLight"
+        for col in lc_alignments.collect_schema().names() if col not in key_cols}
+    return hc_alignments.rename(hc_cols).join(
+        lc_alignments.rename(lc_cols),
+        on=key_cols,
+        how=how,
+        coalesce=True
+    )
+
+
+def ambiguous_reads_expr(key_cols: List[str]) -> pl.Expr:
+    """Share of a joined row in an ambiguous read (one on several rows), else 0."""
+    rows = pl.len().over(key_cols)
+    return pl.when(pl.all_horizontal(pl.col(key_cols).is_not_null()) & (rows > 1)) \
+        .then(1.0 / rows).otherwise(0.0).alias(AMBIGUOUS_READS_COL)
+
+
+def distinct_reads_expr(key_cols: List[str]) -> pl.Expr:
+    """Whether a joined row is the one its read counts at: the heavy and light
+    alignments of a read are crossed, so its first row with the best heavy state
+    (assigned, unassigned, absent), then the best light one, has the best state
+    of each chain. Rows without a read id count as one read each."""
+    def rank(col: str) -> pl.Expr:
+        return pl.when(pl.col(col).is_null()).then(2).when(pl.col(col) == -1).then(1).otherwise(0)
+
+    first = (rank(PAIR_COLS[0]) * 3 + rank(PAIR_COLS[1])).rank("ordinal").over(key_cols) == 1
+    return (pl.any_horizontal(pl.col(key_cols).is_null()) | first).alias(DISTINCT_READS_COL)
+
+
+def with_read_diagnostics(hl: pl.LazyFrame, key_cols: List[str]) -> pl.LazyFrame:
+    return hl.with_columns(ambiguous_reads_expr(key_cols), distinct_reads_expr(key_cols))
+
+
+def paired_clones(cells: pl.LazyFrame) -> pl.LazyFrame:
+    """The pairing table of a diagnostics result: pairs of assigned clones."""
+    return with_fractions(cells.filter(
+        pl.all_horizontal((pl.col(col).is_not_null() & (pl.col(col) != -1)) for col in PAIR_COLS)
+    ).drop(DIAGNOSTICS_COLS))
+
+
+def with_fractions(hl: pl.LazyFrame) -> pl.LazyFrame:
+    if 'umiCount' in hl.collect_schema().names():
+        hl = hl.with_columns(
+            (pl.col('umiCount') / pl.col('umiCount').sum()).alias('umiFraction'))
+    return hl.with_columns(
+        (pl.col('readCount') / pl.col('readCount').sum()).alias('readFraction'))
+
+
+def collect_pairs(hl: pl.LazyFrame, engine: str = "auto") -> pl.DataFrame:
+    """Collects a pairing table with `engine`, and its fractions with the default
+    one: the streaming engine divides by a column sum differently, changing the
+    last digit of some fractions."""
+    counts = hl.drop(FRACTION_COLS, strict=False).collect(engine=engine)
+    return with_fractions(counts.lazy()).collect()
+
+
+def pair_alignments(
+    hc_alignments: pl.LazyFrame,
+    lc_alignments: Optional[pl.LazyFrame],
+    read_id_key: str = "string",
+    profiler: Profiler = DISABLED,
+    umi_count: str = "exact",
+    diagnostics: bool = False,
+    umi_sets: bool = False
+) -> pl.LazyFrame:
+    """Pairs heavy and light clones sharing a read and counts reads (and UMIs)
+    per (cloneId-IGHeavy, cloneId-IGLight) pair; with `umi_sets`, the distinct
+    UMIs are kept too (see UMI_SET_COL).
+
+    With `diagnostics`, the alignments are expected unfiltered, and the result
+    also has the unpaired and unassigned reads and the ambiguous and distinct
+    read counts (see DIAGNOSTICS_COLS), without fractions; `paired_clones` reduces it to
+    the pairing table.
+    """
+    hc_alignments = encode_umis(hc_alignments)
+    if lc_alignments is not None:
+        hc_alignments, key_cols = encode_read_ids(hc_alignments, read_id_key)
+        lc_alignments, _ = encode_read_ids(lc_alignments, read_id_key)
+    else:
+        key_cols = [READ_ID_COL]
+
+    hl = profiler.stage(
+        "pairing join", join_reads(hc_alignments, lc_alignments, key_cols, "full" if diagnostics else "inner"),
+        inputs=[a for a in (hc_alignments, lc_alignments) if a is not None])
+    umi_cols = umi_columns(hl)
+
+    aggs = {"readCount": pl.col(key_cols[0]).count() if umi_cols else pl.len()}
+    if umi_cols and umi_sets:
+        aggs[UMI_SET_COL] = umi_set_expr(umi_cols)
+    elif umi_cols:
+        aggs["umiCount"] = umi_count_expr(umi_cols, umi_count)
+    if diagnostics:
+        hl = with_read_diagnostics(hl, key_cols)
+        aggs.update({col: pl.sum(col) for col in DIAGNOSTICS_COLS})
+    hl = hl.group_by(PAIR_COLS).agg(**aggs)
+    if umi_cols and umi_sets:
+        hl = with_umi_set_counts(hl)
+
+    return profiler.stage(
+        "UMI aggregation" if umi_cols else "read aggregation", hl if diagnostics else with_fractions(hl))
+
+
+def partition_count(paths: List[str], max_memory_gib: float, workers: int) -> int:
+    """Number of buckets keeping each of the concurrent bucket joins within the budget."""
+    input_bytes = sum(uncompressed_size(path) for path in paths)
+    budget_bytes = max_memory_gib * 2 ** 30 / max(workers, 1)
+    return max(1, math.ceil(input_bytes * MEMORY_PER_INPUT_BYTE / budget_bytes))
+
+
+def spill_partitions(
+    path: str,
+    spill_dir: str,
+    partitions: int,
+    read_id_key: str,
+    unassigned: bool = False,
+    unpaired: bool = False
+) -> None:
+    """Streams an alignments TSV (plain or compressed) once, writing its reads
+    into `partitions` buckets; those of no clone only if `unassigned`, those
+    without a read id only if `unpaired` (heavy-only pairing)."""
+    reader = tsv_batches(path, columns=list(alignment_columns(path)))
+    chunk = 0
+    while True:
+        batches = []
+        rows = 0
+        while rows < SPILL_ROWS:
+            batch = next(reader, None)
+            if batch is None:
+                break
+            batches.append(batch)
+            rows += batch.height
+        if not batches:
+            break
+
+        reads = pl.concat(batches).lazy().with_columns(
+            pl.col(CLONE_ID_COL).cast(pl.Int64)
+        ).filter(
+            ((pl.col(CLONE_ID_COL) != -1) | unassigned) & (pl.col(READ_ID_COL).is_not_null() | unpaired)
+        ).with_columns(
+            (pl.col(READ_ID_COL).hash(seed=BUCKET_SEED) % partitions).alias(BUCKET_COL)
+        )
+        reads, _ = encode_read_ids(encode_umis(reads), read_id_key)
+        for (bucket,), part in reads.collect().partition_by(
+                BUCKET_COL, as_dict=True, include_key=False).items():
+            bucket_dir = os.path.join(spill_dir, str(bucket))
+            os.makedirs(bucket_dir, exist_ok=True)
+            part.write_parquet(os.path.join(bucket_dir, f"{chunk}.parquet"))
+        chunk += 1
+
+
+def spill_by_pair(table: pl.DataFrame, pairs_dir: str, partitions: int, name: str) -> None:
+    """Writes the rows of a table of clone pairs into `partitions` buckets by pair."""
+    table = table.with_columns(
+        (pl.struct(PAIR_COLS).hash(seed=PAIR_BUCKET_SEED) % partitions).alias(PAIR_BUCKET_COL))
+    for (bucket,), part in table.partition_by(PAIR_BUCKET_COL, as_dict=True, include_key=False).items():
+        bucket_dir = os.path.join(pairs_dir, str(bucket))
+        os.makedirs(bucket_dir, exist_ok=True)
+        part.write_parquet(os.path.join(bucket_dir, name))
+
+
+def pair_partition(
+    hc_dir: str,
+    lc_dir: Optional[str],
+    pairs_dir: str,
+    partitions: int,
+    read_id_key: str,
+    diagnostics: bool = False
+) -> None:
+    """Joins one read bucket and spills its read counts and distinct UMIs per
+    clone pair (with `diagnostics`, see `pair_alignments`) by pair; without
+    `lc_dir`, counts the heavy reads of the bucket against the synthetic light
+    clone."""
+    key_cols = [READ_ID_COL] if read_id_key == "string" else READ_ID_HASH_COLS
+    if lc_dir is None:
+        if not os.path.isdir(hc_dir):
+            return
+        hl = join_reads(pl.scan_parquet(os.path.join(hc_dir, "*.parquet")), None, key_cols)
+    else:
+        found = [os.path.isdir(hc_dir), os.path.isdir(lc_dir)]
+        if not all(found) and not (diagnostics and any(found)):
+            return
+        hc, lc = (pl.scan_parquet(os.path.join(d, "*.parquet")) if exists else None
+                  for d, exists in zip((hc_dir, lc_dir), found))
+        # a chain without reads in the bucket joins as an empty table
+        hl = join_reads(
+            hc if hc is not None else lc.clear(),
+            lc if lc is not None else hc.clear(),
+            key_cols,
+            "full" if diagnostics else "inner"
+        )
+    umi_cols = umi_columns(hl)
+    # as in `pair_alignments`: heavy-only reads without an id count for UMIs only
+    aggs = {"readCount": pl.col(key_cols[0]).count() if umi_cols else pl.len()}
+    if diagnostics:
+        hl = with_read_diagnostics(hl, key_cols)
+        aggs.update({col: pl.sum(col) for col in DIAGNOSTICS_COLS})
+    bucket = os.path.basename(hc_dir)
+    spill_by_pair(hl.group_by(PAIR_COLS).agg(**aggs).collect(), pairs_dir, partitions,
+                  f"reads-{bucket}.parquet")
+    if umi_cols:
+        spill_by_pair(hl.select(PAIR_COLS + umi_cols).unique().collect(), pairs_dir, partitions,
+                      f"umis-{bucket}.parquet")
+
+
+def merge_pair_bucket(
+    bucket_dir: str, umi_count: str = "exact", diagnostics: bool = False, umi_sets: bool = False
+) -> None:
+    """Sums the read counts and unites the UMIs that every read bucket found
+    for the clone pairs of one pair bucket; writes them to merged.parquet."""
+    sums = ["readCount"] + DIAGNOSTICS_COLS if diagnostics else ["readCount"]
+    hl = pl.scan_parquet(os.path.join(bucket_dir, "reads-*.parquet")).group_by(PAIR_COLS).agg(
+        pl.sum(col) for col in sums)
+    if glob.glob(os.path.join(bucket_dir, "umis-*.parquet")):
+        # a molecule may span read buckets, so UMIs are deduplicated here
+        umis = pl.scan_parquet(os.path.join(bucket_dir, "umis-*.parquet"))
+        umi_cols = [c for c in umis.collect_schema().names() if c not in PAIR_COLS]
+        if umi_sets:
+            umis = with_umi_set_counts(umis.group_by(PAIR_COLS).agg(umiSet=umi_set_expr(umi_cols)))
+        else:
+            umis = umis.group_by(PAIR_COLS).agg(umiCount=umi_count_expr(umi_cols, umi_count))
+        # with diagnostics, the unpaired and unassigned rows count their UMIs too
+        hl = hl.join(umis, on=PAIR_COLS, how="left", nulls_equal=True)
+    hl.sink_parquet(os.path.join(bucket_dir, "merged.parquet"))
+
+
+def run_jobs(function, jobs: List[tuple], workers: int) -> None:
+    """Runs `function` on the argument tuples of `jobs`, in `workers` processes."""
+    if workers > 1:
+        # polars is multi-threaded, so workers are spawned rather than forked
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context) as pool:
+            list(pool.map(function, *zip(*jobs)))
+    else:
+        for job in jobs:
+            function(*job)
+
+
+def pair_alignments_partitioned(
+    hc_path: str,
+    lc_path: Optional[str],
+    read_id_key: str = "string",
+    max_memory_gib: float = 4.0,
+    partitions: Optional[int] = None,
+    workers: int = 1,
+    umi_count: str = "exact",
+    diagnostics: bool = False,
+    umi_sets: bool = False
+) -> pl.LazyFrame:
+    """Out-of-core `pair_alignments`: same result, with peak memory set by the
+    budget rather than by the size of the alignment exports. Reads are joined a
+    read bucket at a time, and their counts and UMIs merged a pair bucket at a
+    time. Without `lc_path` (--no-light), the heavy reads are counted per clone."""
+    paths = {"hc": hc_path} if lc_path is None else {"hc": hc_path, "lc": lc_path}
+    if partitions is None:
+        partitions = partition_count(list(paths.values()), max_memory_gib, workers)
+
+    spill_dir = tempfile.mkdtemp(prefix="pairing-", dir=".")
+    try:
+        # both exports are spilled at once, so that reading one overlaps parsing the other
+        with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+            list(pool.map(
+                lambda chain, path: spill_partitions(
+                    path, os.path.join(spill_dir, chain), partitions, read_id_key, diagnostics,
+                    lc_path is None),
+                paths.keys(), paths.values()))
+
+        pairs_dir = os.path.join(spill_dir, "pairs")
+        run_jobs(pair_partition, [
+            (os.path.join(spill_dir, "hc", str(bucket)),
+             None if lc_path is None else os.path.join(spill_dir, "lc", str(bucket)),
+             pairs_dir,
+             partitions,
+             read_id_key,
+             diagnostics)
+            for bucket in range(partitions)
+        ], workers)
+        bucket_dirs = sorted(glob.glob(os.path.join(pairs_dir, "*")))
+        run_jobs(merge_pair_bucket, [(d, umi_count, diagnostics, umi_sets) for d in bucket_dirs], workers)
+
+        if not bucket_dirs:
+            # no read is shared by heavy and light: the pairing of empty exports,
+            # for its schema (the exports are not read again)
+            empty = [pl.LazyFrame(schema=alignment_columns(path)) for path in (hc_path, lc_path) if path]
+            return pair_alignments(
+                empty[0], empty[1] if lc_path is not None else None, read_id_key,
+                umi_count=umi_count, diagnostics=diagnostics, umi_sets=umi_sets
+            ).collect().lazy()
+        # pair buckets have no pair in common: the result is their concatenation
+        hl = pl.scan_parquet([os.path.join(d, "merged.parquet") for d in bucket_dirs])
+        hl = (hl if diagnostics else with_fractions(hl)).collect()
+    finally:
+        shutil.rmtree(spill_dir, ignore_errors=True)
+    return hl.lazy()
+
+
+def alignments_digest(
+    paths: List[str], no_light: bool, umi_count: str = "exact", umi_sets: bool = False
+) -> str:
+    """Content hash keying the pairing table of these alignment exports."""
+    digest = hashlib.sha256(
+        f"pairs-v{PAIR_TABLE_VERSION} no-light={no_light} umi-count={umi_count} "
+        f"umi-sets={umi_sets}".encode())
+    for path in paths:
+        digest.update(b"\0" + str(os.path.getsize(path)).encode() + b"\0")
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DIGEST_CHUNK_BYTES), b""):
+                digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_pairs(hl: pl.DataFrame, path: str, umi_sets: bool = False) -> None:
+    """Writes the pairing table (clone pairs with read and UMI counts, and the
+    UMI sets, with their key scheme in the metadata, if `umi_sets`)."""
+    # written next to the target and renamed, so a cached table is never partial
+    tmp = path + ".tmp"
+    cols = PAIR_TABLE_COLS + [UMI_SET_COL] if umi_sets else PAIR_TABLE_COLS
+    table = hl.select([c for c in cols if c in hl.columns])
+    metadata = {UMI_KEY_SCHEME_KEY: UMI_KEY_SCHEME} if UMI_SET_COL in table.columns else None
+    table.write_parquet(tmp, compression="zstd", metadata=metadata)
+    os.replace(tmp, path)
+
+
+def scan_pairs(path: str) -> pl.LazyFrame:
+    """Reads a pairing table written by `write_pairs`, as `pair_alignments` returns it."""
+    return with_fractions(pl.scan_parquet(path))
+
+
+def without_umi_sets(hl: pl.LazyFrame) -> pl.LazyFrame:
+    """The pairing table without its UMI sets, which only pairing tables carry."""
+    return hl.drop(UMI_SET_COL, strict=False)
+
+
+def read_clone_map(path: str) -> pl.DataFrame:
+    """Reads a clone-identity mapping TSV (chain, previousCloneId, cloneId)."""
+    cols = [CLONE_MAP_CHAIN_COL, CLONE_MAP_PREVIOUS_COL, CLONE_MAP_CLONE_COL]
+    clone_map = scan_table(path)
+    missing = [col for col in cols if col not in clone_map.collect_schema().names()]
+    if missing:
+        raise ValueError(f"clone map {path} lacks column(s) {', '.join(missing)}")
+    clone_map = clone_map.select(
+        pl.col(CLONE_MAP_CHAIN_COL),
+        pl.col(CLONE_MAP_PREVIOUS_COL, CLONE_MAP_CLONE_COL).cast(pl.Int64)
+    ).collect()
+    if clone_map.select(CLONE_MAP_CHAIN_COL, CLONE_MAP_PREVIOUS_COL).is_duplicated().any():
+        raise ValueError(f"clone map {path} maps a previous cloneId of a chain more than once")
+    return clone_map
+
+
+def remap_clones(previous: pl.DataFrame, clone_map: pl.DataFrame) -> pl.DataFrame:
+    """The clone pairs of a previous pairing table under the current cloneIds;
+    pairs with a clone mapped to -1 are dropped. A chain the map has no rows
+    for (the synthetic light clone of --no-light runs) keeps its ids."""
+    for col in PAIR_COLS:
+        chain = col.split("-", 1)[1]
+        mapping = clone_map.filter(pl.col(CLONE_MAP_CHAIN_COL) == chain).select(
+            pl.col(CLONE_MAP_PREVIOUS_COL).cast(previous.schema[col]).alias(col),
+            pl.col(CLONE_MAP_CLONE_COL).cast(previous.schema[col]).alias("_mapped"))
+        if mapping.height == 0:
+            continue
+        previous = previous.join(mapping, on=col, how="left")
+        unmapped = previous.filter(pl.col("_mapped").is_null()).get_column(col).unique().sort()
+        if len(unmapped):
+            raise ValueError(f"clone map has no {chain} cloneId for previous cloneId(s) "
+                             + ", ".join(map(str, unmapped.head(10).to_list())))
+        previous = previous.with_columns(pl.col("_mapped").alias(col)).drop("_mapped") \
+            .filter(pl.col(col) != -1)
+    return previous
+
+
+def top_up_pairs(
+    previous_path: str,
+    new: pl.LazyFrame,
+    clone_map: Optional[pl.DataFrame] = None
+) -> pl.LazyFrame:
+    """Merges the clone pairs of new reads into a previous pairing table (read
+    with `write_pairs(umi_sets=True)`): read counts are summed and UMI sets
+    united, as pairing the old and the new reads together would count them.
+    The previous cloneIds are translated with `clone_map`, else kept."""
+    previous = pl.read_parquet(previous_path)
+    new_cols = new.collect_schema().names()
+    if (UMI_SET_COL in new_cols) != (UMI_SET_COL in previous.columns):
+        raise ValueError(f"{previous_path} has no UMI sets (write it with --pairs-umi-sets)"
+                         if UMI_SET_COL in new_cols else
+                         f"{previous_path} has UMI sets, the new alignments have no UMIs")
+    if UMI_SET_COL in new_cols:
+        scheme = pl.read_parquet_metadata(previous_path).get(UMI_KEY_SCHEME_KEY)
+        if scheme != UMI_KEY_SCHEME:
+            raise ValueError(f"{previous_path} has UMI sets keyed by {scheme or 'an older scheme'}, "
+                             f"not {UMI_KEY_SCHEME}; pair its reads again with --pairs-umi-sets")
+    cols = PAIR_COLS + ["readCount"] + ([UMI_SET_COL] if UMI_SET_COL in new_cols else [])
+    previous = previous.select(cols)
+    if clone_map is not None:
+        previous = remap_clones(previous, clone_map)
+    hl = pl.concat([previous.lazy(), new.select(cols)], how="vertical_relaxed") \
+        .group_by(PAIR_COLS).agg(
+            [pl.sum("readCount")]
+            + ([pl.col(UMI_SET_COL).flatten().unique().sort()] if UMI_SET_COL in cols else []))
+    if UMI_SET_COL in cols:
+        hl = with_umi_set_counts(hl)
+    return with_fractions(hl)
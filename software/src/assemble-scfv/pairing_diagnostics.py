@@ -0,0 +1,128 @@
+import json
+from typing import Dict, Optional
+
+import polars as pl
+
+from pairing import AMBIGUOUS_READS_COL, DISTINCT_READS_COL, PAIR_COLS
+
+# State of a read's alignment in one chain, by its cloneId there
+ASSIGNED = "assigned"
+UNASSIGNED = "unassigned"  # cloneId -1
+ABSENT = "absent"  # no alignment of the read in the chain (null cloneId)
+REPORT_VERSION = 2
+
+CHAIN_COL = "chain"
+CLONE_ID_COL = "cloneId"
+
+
+def chain_state(col: str) -> pl.Expr:
+    clone_id = pl.col(col)
+    return pl.when(clone_id.is_null()).then(pl.lit(ABSENT)) \
+        .when(clone_id == -1).then(pl.lit(UNASSIGNED)).otherwise(pl.lit(ASSIGNED))
+
+
+def pairing_summary(cells: pl.DataFrame, no_light: bool) -> dict:
+    """Distinct reads by the state of their heavy and light alignments,
+    ambiguous reads and the clone-level pairing of a
+    `pair_alignments(diagnostics=True)` result. A read on several alignments
+    of a chain counts once, in the best state it has there. Without light
+    alignments (--no-light), the light and pairing figures are null."""
+    heavy_col, light_col = PAIR_COLS
+    # the synthetic light clone of --no-light has no state
+    light_state = pl.lit(None, dtype=pl.String) if no_light else chain_state(light_col)
+    states = cells.group_by(
+        chain_state(heavy_col).alias("heavy"), light_state.alias("light")
+    ).agg(reads=pl.sum(DISTINCT_READS_COL)).sort("heavy", "light")
+    by_state: Dict[tuple, int] = {(h, l): int(n) for h, l, n in states.iter_rows()}
+    total = sum(by_state.values())
+
+    def in_chain(chain: int, state: str) -> Optional[int]:
+        if chain == 1 and no_light:
+            return None
+        return sum(n for key, n in by_state.items() if key[chain] == state)
+
+    def of_state(heavy: str, light: str) -> Optional[int]:
+        return None if no_light else by_state.get((heavy, light), 0)
+
+    paired = of_state(ASSIGNED, ASSIGNED)
+    clones = clone_pairing(cells, no_light)
+    return {
+        "version": REPORT_VERSION,
+        "reads": {
+            "total": total,
+            "paired": paired,
+            "heavyAssigned": in_chain(0, ASSIGNED),
+            "lightAssigned": in_chain(1, ASSIGNED),
+            "heavyOnly": of_state(ASSIGNED, ABSENT),
+            "lightOnly": of_state(ABSENT, ASSIGNED),
+            "heavyUnassigned": in_chain(0, UNASSIGNED),
+            "lightUnassigned": in_chain(1, UNASSIGNED),
+            "ambiguous": round(float(cells.get_column(AMBIGUOUS_READS_COL).sum()), 3),
+            "pairingEfficiency": round(paired / total, 6) if total and paired is not None else None,
+        },
+        "readsByChainState": [
+            {"heavy": h, "light": l, "reads": n} for (h, l), n in by_state.items()
+        ],
+        "clonePairs": None if no_light else cells.filter(
+            (chain_state(heavy_col) == ASSIGNED) & (chain_state(light_col) == ASSIGNED)).height,
+        "clones": {
+            chain: clone_summary(clones.filter(pl.col(CHAIN_COL) == chain))
+            for chain in clones.get_column(CHAIN_COL).unique(maintain_order=True)
+        },
+    }
+
+
+def clone_pairing(cells: pl.DataFrame, no_light: bool) -> pl.DataFrame:
+    """Per assigned clone of each chain: its paired reads, reads whose other
+    chain is absent or unassigned, distinct partner clones, the share of the
+    paired reads going to the top partner, and ambiguous reads."""
+    chains = [("IGHeavy", PAIR_COLS[0], PAIR_COLS[1])]
+    if not no_light:
+        chains.append(("IGLight", PAIR_COLS[1], PAIR_COLS[0]))
+    tables = []
+    for chain, own, other in chains:
+        paired = chain_state(other) == ASSIGNED
+        reads = pl.col("readCount")
+        tables.append(cells.filter(chain_state(own) == ASSIGNED).group_by(own).agg(
+            pairedReads=reads.filter(paired).sum(),
+            partnerAbsentReads=reads.filter(chain_state(other) == ABSENT).sum(),
+            partnerUnassignedReads=reads.filter(chain_state(other) == UNASSIGNED).sum(),
+            partners=paired.sum(),
+            topPartnerReads=reads.filter(paired).max(),
+            ambiguousReads=pl.sum(AMBIGUOUS_READS_COL),
+        ).select(
+            pl.lit(chain).alias(CHAIN_COL),
+            pl.col(own).cast(pl.Int64).alias(CLONE_ID_COL),
+            pl.exclude(own, "topPartnerReads"),
+            (pl.col("topPartnerReads") / pl.col("pairedReads")).alias("topPartnerFraction"),
+        ).sort(CLONE_ID_COL))
+    return pl.concat(tables)
+
+
+def clone_summary(clones: pl.DataFrame) -> dict:
+    """How unambiguously the clones of one chain pair."""
+    paired = clones.filter(pl.col("partners") > 0)
+    return {
+        "clones": clones.height,
+        "paired": paired.height,
+        "multiplePartners": paired.filter(pl.col("partners") > 1).height,
+        "medianTopPartnerFraction": round(paired.get_column("topPartnerFraction").median(), 6)
+        if paired.height else None,
+        "readWeightedTopPartnerFraction": round(
+            float(paired.get_column("topPartnerFraction").dot(paired.get_column("pairedReads"))
+                  / paired.get_column("pairedReads").sum()), 6) if paired.height else None,
+    }
+
+
+def write_pairing_diagnostics(
+    cells: pl.DataFrame,
+    no_light: bool,
+    report_path: Optional[str] = None,
+    clones_path: Optional[str] = None
+) -> None:
+    """Writes the summary as JSON and the per-clone pairing as TSV."""
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(pairing_summary(cells, no_light), f, indent=2)
+    if clones_path is not None:
+        clone_pairing(cells, no_light).write_csv(clones_path, separator="\t")
@@ -0,0 +1,100 @@
+import json
+import resource
+import time
+from contextlib import contextmanager
+from typing import Iterator, List, Optional, Sequence
+
+import polars as pl
+
+
+def peak_rss_mib() -> float:
+    """RSS high-water mark of this process and its finished children (Linux, KiB)."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+def cpu_seconds() -> float:
+    """CPU time of this process (all threads) and its finished children."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+class Profiler:
+    """Per-stage wall time, CPU time, row counts and peak RSS of a run.
+
+    An enabled profiler (`--profile-json`) collects every stage on its own, so
+    that its cost can be attributed to it; lazy stages are not fused across
+    profiled boundaries and peak memory can be higher than in a normal run.
+    A disabled profiler returns the lazy frames untouched.
+    """
+
+    def __init__(self, path: Optional[str] = None, engine: str = "auto"):
+        self.path = path
+        self.engine = engine
+        self.stages: List[dict] = []
+        # rows out of the last profiled stage, the default rows in of the next one
+        self.rows: Optional[int] = None
+        self.start_wall = time.perf_counter()
+        self.start_cpu = cpu_seconds()
+
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None
+
+    def count(self, lf: pl.LazyFrame) -> int:
+        return lf.select(pl.len()).collect().item()
+
+    @contextmanager
+    def measure(self, name: str, rows_in: Optional[int] = None, **info) -> Iterator[dict]:
+        """Times the enclosed block; the caller may set "rows_out" on the yielded record."""
+        record = {"stage": name, **info, "rows_in": rows_in}
+        wall, cpu = time.perf_counter(), cpu_seconds()
+        yield record
+        record["wall_s"] = round(time.perf_counter() - wall, 6)
+        record["cpu_s"] = round(cpu_seconds() - cpu, 6)
+        record.setdefault("rows_out", None)
+        record["peak_rss_mib"] = round(peak_rss_mib(), 1)
+        self.rows = record["rows_out"]
+        self.stages.append(record)
+
+    def stage(
+        self,
+        name: str,
+        lf: pl.LazyFrame,
+        inputs: Optional[Sequence[pl.LazyFrame]] = None,
+        **info
+    ) -> pl.LazyFrame:
+        """Collects a stage when profiling.
+
+        Rows in are those of `inputs` (frames returned by earlier stages), or
+        the rows out of the previous stage if not given; `inputs=[]` marks a
+        stage reading from disk.
+        """
+        if not self.enabled:
+            return lf
+        if inputs is None:
+            rows_in = self.rows
+        else:
+            rows_in = sum(self.count(x) for x in inputs) if inputs else None
+        with self.measure(name, rows_in, **info) as record:
+            df = lf.collect(engine=self.engine)
+            record["rows_out"] = df.height
+        return df.lazy()
+
+    def write(self) -> None:
+        if not self.enabled:
+            return
+        report = {
+            "engine": self.engine,
+            "stages": self.stages,
+            "total": {
+                "wall_s": round(time.perf_counter() - self.start_wall, 6),
+                "cpu_s": round(cpu_seconds() - self.start_cpu, 6),
+                "peak_rss_mib": round(peak_rss_mib(), 1),
+            },
+        }
+        with open(self.path, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+DISABLED = Profiler()
@@ -0,0 +1,262 @@
+import gzip
+import os
+import queue
+import threading
+import zlib
+from contextlib import contextmanager
+from typing import IO, Iterator, List, Optional
+
+import polars as pl
+import zstandard
+
+# Intermediate tables passed between steps are written in one of the
+# columnar formats, compressed with zstd; the format follows the extension.
+PARQUET_SUFFIXES = (".parquet",)
+IPC_SUFFIXES = (".arrow", ".ipc", ".feather")
+
+# TSV tables (MiXCR exports, results) may be gzip or zstd compressed, by extension
+ZSTD_SUFFIX = ".zst"
+GZIP_SUFFIX = ".gz"
+COMPRESSED_SUFFIXES = (ZSTD_SUFFIX, GZIP_SUFFIX)
+# Inputs are recognized by content, as polars does, whatever their name
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_LEVEL = 3
+GZIP_LEVEL = 6
+# Decompressed bytes per batch of `tsv_batches`, and batches decompressed ahead
+BATCH_BYTES = 16 * 2 ** 20
+BATCHES_AHEAD = 2
+# Bytes read at a time while looking for the end of a header line
+HEADER_CHUNK_BYTES = 64 * 2 ** 10
+# Compressed bytes decompressed to estimate the compression ratio of a file
+RATIO_SAMPLE_BYTES = 4 * 2 ** 20
+
+
+def table_format(path: str) -> str:
+    lower = path.lower()
+    if lower.endswith(PARQUET_SUFFIXES):
+        return "parquet"
+    if lower.endswith(IPC_SUFFIXES):
+        return "ipc"
+    return "tsv"
+
+
+def compression(path: str) -> Optional[str]:
+    """Compression of an output, by extension."""
+    lower = path.lower()
+    if lower.endswith(ZSTD_SUFFIX):
+        return "zstd"
+    if lower.endswith(GZIP_SUFFIX):
+        return "gzip"
+    return None
+
+
+def input_compression(path: str) -> Optional[str]:
+    """Compression of an input, by its leading magic bytes."""
+    with open(path, "rb") as f:
+        head = f.read(len(ZSTD_MAGIC))
+    if head.startswith(ZSTD_MAGIC):
+        return "zstd"
+    if head.startswith(GZIP_MAGIC):
+        return "gzip"
+    return None
+
+
+def input_path(path: str) -> str:
+    """`path` if it exists, otherwise its existing compressed variant (.zst, .gz)."""
+    if not os.path.exists(path):
+        for suffix in COMPRESSED_SUFFIXES:
+            if os.path.exists(path + suffix):
+                return path + suffix
+    return path
+
+
+def open_input(path: str) -> IO[bytes]:
+    """Opens a file for reading, decompressing it as a stream."""
+    kind = input_compression(path)
+    if kind == "zstd":
+        return zstandard.open(path, "rb")
+    if kind == "gzip":
+        return gzip.open(path, "rb")
+    return open(path, "rb")
+
+
+@contextmanager
+def open_output(path: str) -> Iterator[IO[bytes]]:
+    """Opens a TSV output for writing, compressed by its extension; zstd
+    compresses on its own threads while the table is serialized."""
+    kind = compression(path)
+    if kind == "zstd":
+        cctx = zstandard.ZstdCompressor(level=ZSTD_LEVEL, threads=-1)
+        with zstandard.open(path, "wb", cctx=cctx) as f:
+            yield f
+    elif kind == "gzip":
+        with gzip.open(path, "wb", compresslevel=GZIP_LEVEL) as f:
+            yield f
+    else:
+        with open(path, "wb") as f:
+            yield f
+
+
+def read_header(path: str) -> List[str]:
+    """Column names of a TSV (plain or compressed), from its first line only."""
+    line = b""
+    with open_input(path) as f:
+        # zstd streams have no readline
+        while b"\n" not in line:
+            chunk = f.read(HEADER_CHUNK_BYTES)
+            if not chunk:
+                break
+            line += chunk
+    return line.split(b"\n", 1)[0].decode().rstrip("\r").split("\t")
+
+
+def _decompressed_length(data: bytes, kind: str) -> int:
+    """Bytes `data`, a prefix of a compressed file, decompresses to."""
+    if kind == "zstd":
+        return len(zstandard.ZstdDecompressor().decompressobj(read_across_frames=True).decompress(data))
+    length = 0
+    while data:
+        # concatenated gzip members, as written by parallel compressors
+        d = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        length += len(d.decompress(data))
+        data = d.unused_data
+    return length
+
+
+def uncompressed_size(path: str) -> int:
+    """Size of the file, for compressed files extrapolated from the
+    compression ratio of their first RATIO_SAMPLE_BYTES."""
+    size = os.path.getsize(path)
+    kind = input_compression(path)
+    if kind is None:
+        return size
+    with open(path, "rb") as f:
+        data = f.read(RATIO_SAMPLE_BYTES)
+    return round(_decompressed_length(data, kind) * size / max(len(data), 1))
+
+
+def _blocks(path: str, batch_bytes: int) -> Iterator[bytes]:
+    """The file in blocks of about `batch_bytes`, cut after a newline."""
+    with open_input(path) as f:
+        rest = b""
+        while True:
+            block = f.read(batch_bytes)
+            if not block:
+                break
+            block = rest + block
+            cut = block.rfind(b"\n") + 1
+            rest = block[cut:]
+            if cut:
+                yield block[:cut]
+        if rest:
+            yield rest
+
+
+def _read_ahead(blocks: Iterator[bytes], depth: int) -> Iterator[bytes]:
+    """Iterates `blocks` on a background thread, `depth` blocks ahead."""
+    ahead: queue.Queue = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+    failure: List[BaseException] = []
+
+    def produce() -> None:
+        try:
+            for block in blocks:
+                if stop.is_set():
+                    break
+                ahead.put(block)
+        except BaseException as e:
+            failure.append(e)
+        finally:
+            blocks.close()
+            ahead.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while (block := ahead.get()) is not done:
+            yield block
+    finally:
+        # the reader stopped early: unblock the producer so it closes the file
+        stop.set()
+        while block is not done:
+            block = ahead.get()
+    if failure:
+        raise failure[0]
+
+
+def tsv_batches(
+    path: str,
+    batch_bytes: int = BATCH_BYTES,
+    ahead: int = BATCHES_AHEAD,
+    columns: Optional[List[str]] = None
+) -> Iterator[pl.DataFrame]:
+    """Reads a TSV in batches of about `batch_bytes`, all columns as String
+    (only those of `columns` found in the header, if given); a file without
+    rows gives one empty batch.
+
+    The file is read (and decompressed) on a background thread while the
+    previous batch is parsed, so memory stays bounded for any file size.
+    """
+    header: Optional[List[str]] = None
+    selected: Optional[List[int]] = None
+    rows = False
+    for block in _read_ahead(_blocks(path, batch_bytes), ahead):
+        if header is None:
+            line_end = block.find(b"\n") + 1 or len(block)
+            header = block[:line_end].decode().rstrip("\r\n").split("\t")
+            if columns is not None:
+                selected = [i for i, col in enumerate(header) if col in columns]
+                header = [header[i] for i in selected]
+            block = block[line_end:]
+            if not block:
+                continue
+        rows = True
+        yield pl.read_csv(block, separator="\t", has_header=False, columns=selected,
+                          new_columns=header, infer_schema=False)
+    if not rows:
+        yield pl.DataFrame(schema={col: pl.String for col in header or []})
+
+
+def scan_table(path: str, schema_overrides: Optional[dict] = None) -> pl.LazyFrame:
+    """Lazily reads a table; TSV columns are read as String unless overridden.
+    polars decompresses gzip and zstd TSV itself, into memory as a whole before
+    parsing, so streaming queries over plain TSV use less memory; bounded reads
+    of compressed files go through `tsv_batches`."""
+    fmt = table_format(path)
+    if fmt == "parquet":
+        return pl.scan_parquet(path)
+    if fmt == "ipc":
+        return pl.scan_ipc(path, memory_map=False)
+    return pl.scan_csv(
+        path,
+        separator="\t",
+        infer_schema=False,
+        schema_overrides=schema_overrides,
+    )
+
+
+def write_table(df: pl.DataFrame, path: str) -> None:
+    fmt = table_format(path)
+    if fmt == "parquet":
+        df.write_parquet(path, compression="zstd")
+    elif fmt == "ipc":
+        df.write_ipc(path, compression="zstd")
+    elif compression(path) is None:
+        df.write_csv(path, separator="\t")
+    else:
+        with open_output(path) as f:
+            df.write_csv(f, separator="\t")
+
+
+def sink_table(lf: pl.LazyFrame, path: str, engine: str = "auto") -> None:
+    fmt = table_format(path)
+    if fmt == "parquet":
+        lf.sink_parquet(path, compression="zstd", engine=engine)
+    elif fmt == "ipc":
+        lf.sink_ipc(path, compression="zstd", engine=engine)
+    elif compression(path) is None:
+        lf.sink_csv(path, separator="\t", engine=engine)
+    else:
+        with open_output(path) as f:
+            lf.sink_csv(f, separator="\t", engine=engine)
@@ -0,0 +1,181 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Dict, Optional
+
+import numpy as np
+import polars as pl
+
+# Standard genetic code
+GENETIC_CODE = {
+    "ATA": "I", "ATC": "I", "ATT": "I", "ATG": "M",
+    "ACA": "T", "ACC": "T", "ACG": "T", "ACT": "T",
+    "AAC": "N", "AAT": "N", "AAA": "K", "AAG": "K",
+    "AGC": "S", "AGT": "S", "AGA": "R", "AGG": "R",
+    "CTA": "L", "CTC": "L", "CTG": "L", "CTT": "L",
+    "CCA": "P", "CCC": "P", "CCG": "P", "CCT": "P",
+    "CAC": "H", "CAT": "H", "CAA": "Q", "CAG": "Q",
+    "CGA": "R", "CGC": "R", "CGG": "R", "CGT": "R",
+    "GTA": "V", "GTC": "V", "GTG": "V", "GTT": "V",
+    "GCA": "A", "GCC": "A", "GCG": "A", "GCT": "A",
+    "GAC": "D", "GAT": "D", "GAA": "E", "GAG": "E",
+    "GGA": "G", "GGC": "G", "GGG": "G", "GGT": "G",
+    "TCA": "S", "TCC": "S", "TCG": "S", "TCT": "S",
+    "TTC": "F", "TTT": "F", "TTA": "L", "TTG": "L",
+    "TAC": "Y", "TAT": "Y", "TAA": "*", "TAG": "*",
+    "TGC": "C", "TGT": "C", "TGA": "*", "TGG": "W",
+}
+
+# Stop codons by type, as named in --stop-codon-replacements
+STOP_CODONS = {"amber": "TAG", "ochre": "TAA", "opal": "TGA"}
+
+NUCLEOTIDES = "ACGT"
+# Code of any byte that is not a (case-insensitive) nucleotide
+UNKNOWN_NT = len(NUCLEOTIDES)
+# Rows are translated in chunks of this size, chunks are spread over threads
+CHUNK_ROWS = 65536
+
+
+def _nt_codes() -> np.ndarray:
+    codes = np.full(256, UNKNOWN_NT, dtype=np.uint8)
+    for i, nt in enumerate(NUCLEOTIDES):
+        codes[ord(nt)] = i
+        codes[ord(nt.lower())] = i
+    return codes
+
+
+def _codon_table(code: Dict[str, str]) -> np.ndarray:
+    # Indexed by 25 * n1 + 5 * n2 + n3; codons with an unknown letter map to 'X'
+    table = np.full((UNKNOWN_NT + 1) ** 3, ord("X"), dtype=np.uint8)
+    for codon, aa in code.items():
+        n1, n2, n3 = (NUCLEOTIDES.index(nt) for nt in codon)
+        table[25 * n1 + 5 * n2 + n3] = ord(aa)
+    return table
+
+
+NT_CODES = _nt_codes()
+CODON_TABLE = _codon_table(GENETIC_CODE)
+
+
+def stop_codon_code(replacements: Dict[str, str]) -> Dict[str, str]:
+    """The genetic code with stop codons replaced by amino acids.
+
+    `replacements` maps a stop type of STOP_CODONS to an amino acid, '*'
+    keeping the stop. Replaced codons translate to the lower-case amino acid,
+    so `replace_stop_codons` can tell them from coded ones.
+    """
+    code = dict(GENETIC_CODE)
+    for stop_type, aa in replacements.items():
+        if aa != "*":
+            code[STOP_CODONS[stop_type]] = aa.lower()
+    return code
+
+
+def translate(seq: Optional[str], code: Dict[str, str] = GENETIC_CODE) -> Optional[str]:
+    """Translates a single nucleotide sequence.
+
+    Unknown codons are translated to 'X'; a trailing incomplete codon is
+    dropped and marked with a '_' suffix.
+    """
+    if seq is None:
+        return None
+    protein = ""
+    # Read in codons (3 nucleotides at a time)
+    for i in range(0, len(seq), 3):
+        codon = seq[i:i + 3].upper()
+        # Skip if incomplete codon
+        if len(codon) < 3:
+            continue
+        protein += code.get(codon, "X")
+    # Add underscore if sequence length is not divisible by 3
+    if len(seq) % 3 != 0:
+        protein += "_"
+    return protein
+
+
+def _translate_chunk(table: np.ndarray, seqs: pl.Series) -> pl.Series:
+    lengths = seqs.str.len_bytes().fill_null(0).to_numpy().astype(np.int64)
+    n = len(lengths)
+    data = seqs.fill_null("").str.join("").item().encode()
+    codes = NT_CODES[np.frombuffer(data, dtype=np.uint8)]
+
+    n_codons = lengths // 3
+    has_tail = lengths % 3 != 0
+    # Every output row is followed by a '\n' separator, used to split it back
+    out_lengths = n_codons + has_tail + 1
+
+    in_starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(lengths[:-1], out=in_starts[1:])
+    out_starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(out_lengths[:-1], out=out_starts[1:])
+    codon_starts = np.zeros(n, dtype=np.int64)
+    np.cumsum(n_codons[:-1], out=codon_starts[1:])
+
+    codon_idx = np.arange(int(n_codons.sum()), dtype=np.int64)
+    in_pos = np.repeat(in_starts - 3 * codon_starts, n_codons) + 3 * codon_idx
+    out_pos = np.repeat(out_starts - codon_starts, n_codons) + codon_idx
+
+    out = np.empty(int(out_lengths.sum()), dtype=np.uint8)
+    out[out_pos] = table[
+        25 * codes[in_pos] + 5 * codes[in_pos + 1] + codes[in_pos + 2]]
+    out[(out_starts + n_codons)[has_tail]] = ord("_")
+    out[out_starts + out_lengths - 1] = ord("\n")
+
+    text = out[:-1].tobytes().decode() if n > 0 else ""
+    return pl.Series([text]).str.split("\n").explode()
+
+
+def translate_series(seqs: pl.Series, code: Dict[str, str] = GENETIC_CODE) -> pl.Series:
+    """Translates a String column in bulk, row-for-row identical to `translate`.
+
+    The column is processed as byte buffers with a codon lookup table, in
+    chunks translated concurrently (NumPy releases the GIL). Rows with
+    non-ASCII characters, whose byte and character lengths differ, fall back
+    to the per-row `translate`.
+    """
+    if len(seqs) == 0:
+        return pl.Series(seqs.name, [], dtype=pl.String)
+    seqs = seqs.cast(pl.String)
+    non_ascii = (seqs.str.len_bytes() != seqs.str.len_chars()).fill_null(False)
+    ascii_seqs = seqs.set(non_ascii, "") if non_ascii.any() else seqs
+
+    chunks = [ascii_seqs.slice(offset, CHUNK_ROWS)
+              for offset in range(0, len(ascii_seqs), CHUNK_ROWS)]
+    table = CODON_TABLE if code is GENETIC_CODE else _codon_table(code)
+    with ThreadPoolExecutor(max_workers=min(len(chunks), os.cpu_count() or 1)) as pool:
+        translated = pl.concat(list(pool.map(partial(_translate_chunk, table), chunks)))
+
+    if non_ascii.any():
+        fallback = seqs.filter(non_ascii).map_elements(
+            partial(translate, code=code), return_dtype=pl.String)
+        translated = translated.scatter(non_ascii.arg_true(), fallback)
+    return pl.select(
+        pl.when(seqs.is_null()).then(None).otherwise(translated)
+    ).to_series().alias(seqs.name)
+
+
+def translate_expr(expr: pl.Expr, code: Dict[str, str] = GENETIC_CODE) -> pl.Expr:
+    """Expression form of `translate_series`."""
+    return expr.map_batches(
+        partial(translate_series, code=code), return_dtype=pl.String, is_elementwise=True)
+
+
+def replace_stop_codons(aa: pl.Series, nt: pl.Series, code: Dict[str, str]) -> pl.Series:
+    """Replaces the stops of an amino acid column whose codons `code` (from
+    `stop_codon_code`) replaces; other rows are returned untouched.
+
+    `nt` is translated in frame; a row is rewritten only where the translation
+    is as long as the amino acid sequence (no frameshift), and only at the '*'
+    positions where the translation has a replaced codon.
+    """
+    marked = translate_series(nt, code)
+    hit = (marked.str.contains("[a-z]") & (marked.str.len_bytes() == aa.str.len_bytes())).fill_null(False)
+    if not hit.any():
+        return aa
+    # rows are joined on '\n' in both columns, so bytes line up position by position
+    old = np.frombuffer(aa.filter(hit).str.join("\n").item().encode(), dtype=np.uint8).copy()
+    new = np.frombuffer(marked.filter(hit).str.join("\n").item().encode(), dtype=np.uint8)
+    replaced = (new >= ord("a")) & (new <= ord("z")) & (old == ord("*"))
+    old[replaced] = new[replaced] - (ord("a") - ord("A"))
+    rows = pl.Series([old.tobytes().decode()]).str.split("\n").explode()
+    return aa.clone().scatter(hit.arg_true(), rows)
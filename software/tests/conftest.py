@@ -0,0 +1,19 @@
+"""Test setup: the assemble-scfv modules and the benchmark generator are
+imported by name, as the entrypoints import each other.
+
+    python -m pytest software/tests
+"""
+import sys
+
+import pytest
+
+from synthetic import BENCH, SRC, write_alignments
+
+sys.path.insert(0, SRC)
+sys.path.insert(0, BENCH)
+
+
+@pytest.fixture
+def alignments_dir(tmp_path):
+    write_alignments(str(tmp_path), seed=1)
+    return str(tmp_path)
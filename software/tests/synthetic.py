@@ -0,0 +1,47 @@
+"""Small synthetic MiXCR alignment exports for the pairing tests."""
+import os
+from typing import Optional
+
+import numpy as np
+import polars as pl
+
+SRC = os.path.join(os.path.dirname(__file__), "..", "src", "assemble-scfv")
+BENCH = os.path.join(os.path.dirname(__file__), "..", "bench")
+
+
+def write_alignments(
+    directory: str,
+    seed: int,
+    reads: int = 3000,
+    clones: int = 40,
+    umi: bool = True,
+    first_read: int = 0
+) -> None:
+    """Random hc/lc.alignments.tsv with the cases pairing has to handle: reads
+    of one chain only, unassigned alignments (cloneId -1), reads on several
+    alignments of a chain and UMIs shared by several reads."""
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    for chain in ("hc", "lc"):
+        ids = np.arange(first_read, first_read + reads)
+        # about 1 in 5 reads is absent from the chain, 1 in 20 is there twice
+        ids = ids[rng.random(reads) > 0.2]
+        ids = np.concatenate([ids, ids[rng.random(len(ids)) < 0.05]])
+        clone_ids = rng.integers(0, clones, len(ids))
+        clone_ids[rng.random(len(ids)) < 0.1] = -1
+        columns = {
+            "cloneId": clone_ids,
+            "descrR1": [f"@READ:{i} 1:N:0:1" for i in ids],
+        }
+        if umi:
+            columns["tagValueUMI"] = ["".join(codon) for codon in
+                                      np.array(list("ACGT"))[rng.integers(0, 4, (len(ids), 6))]]
+        pl.DataFrame(columns).sample(fraction=1.0, shuffle=True, seed=seed).write_csv(
+            os.path.join(directory, f"{chain}.alignments.tsv"), separator="\t")
+
+
+def sorted_pairs(df: pl.DataFrame, columns: Optional[list] = None) -> pl.DataFrame:
+    """A pairing table in a canonical row and column order."""
+    columns = columns or df.columns
+    return df.select(columns).sort(columns[:2], nulls_last=True)
+
@@ -0,0 +1,78 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from aggregate_samples import KEY_COL, NOT_COVERED, SampleMerge, aggregate_samples
+
+PARAMS = {
+    "mainAbundanceColumnNormalized": "readFraction",
+    "mainAbundanceColumnUnnormalized": "readCount",
+    "cloneColumns": [KEY_COL, "aaSeqCDR3", "bestVGene"],
+    "cloneColumnSpecs": [{"column": "bestVGene", "spec": {"valueType": "String"}}],
+    "shmMapping": [
+        {"heavyColumn": "cdrHeavy", "lightColumn": "cdrLight", "outputColumn": "nAAMutationsCDR"},
+        {"heavyColumn": "fwrHeavy", "outputColumn": "nAAMutationsFWR"},
+    ],
+}
+
+
+def write_sample(path: str, seed: int, rows: int = 250, keys: int = 400) -> None:
+    rng = np.random.default_rng(seed)
+    key_ids = np.sort(rng.choice(keys, rows, replace=False))
+    mutations = [[NOT_COVERED if rng.random() < 0.1 else str(n) for n in rng.integers(0, 5, rows)]
+                 for _ in range(3)]
+    pl.DataFrame({
+        KEY_COL: [f"K{k:05d}" for k in key_ids],
+        "aaSeqCDR3": [f"CAR{seed}S{i}" for i in range(rows)],
+        "bestVGene": [f"IGHV{seed}-{i}" for i in range(rows)],
+        # few distinct fractions, so samples tie on the most abundant row
+        "readFraction": rng.integers(1, 5, rows) / 8,
+        "readCount": rng.integers(1, 100, rows),
+        "cdrHeavy": mutations[0],
+        "cdrLight": mutations[1],
+        "fwrHeavy": mutations[2],
+    }).write_csv(path, separator="\t")
+
+
+def aggregate_in_memory(paths) -> str:
+    """The merged table of group_by + the row of the first maximal fraction."""
+    merge = SampleMerge(PARAMS)
+    rows = pl.concat([merge.prepare(pl.read_csv(path, separator="\t", infer_schema=False), path)
+                      for path in paths])
+    most_abundant = pl.col(merge.normalized).arg_max()
+    merged = rows.group_by(KEY_COL).agg(
+        [pl.col(col).get(most_abundant) for col in merge.attribute_cols] + [
+            pl.len().cast(pl.UInt32).alias("sampleCount"),
+            pl.col(merge.unnormalized).sum().alias(merge.unnormalized + "Sum"),
+        ]).sort(KEY_COL)
+    return merge.finish(merged).write_csv(separator="\t")
+
+
+@pytest.mark.parametrize("batch_bytes", [256, 4096, 2 ** 20])
+def test_merge_as_in_memory(tmp_path, batch_bytes):
+    paths = [str(tmp_path / f"sample{i}.tsv") for i in range(4)]
+    for seed, path in enumerate(paths):
+        write_sample(path, seed)
+    output = str(tmp_path / "merged.tsv")
+    rows = aggregate_samples(paths, PARAMS, output, batch_bytes)
+    with open(output) as f:
+        merged = f.read()
+    assert merged == aggregate_in_memory(paths)
+    assert rows == len(merged.splitlines()) - 1
+
+
+def test_merge_of_empty_samples(tmp_path):
+    path = str(tmp_path / "empty.tsv")
+    write_sample(path, seed=0, rows=0)
+    output = str(tmp_path / "merged.tsv")
+    assert aggregate_samples([path, path], PARAMS, output, 256) == 0
+    with open(output) as f:
+        assert f.read() == aggregate_in_memory([path])
+
+
+def test_unsorted_sample_is_rejected(tmp_path):
+    path = str(tmp_path / "unsorted.tsv")
+    write_sample(path, seed=0)
+    pl.read_csv(path, separator="\t").reverse().write_csv(path, separator="\t")
+    with pytest.raises(ValueError, match="not sorted"):
+        aggregate_samples([path], PARAMS, str(tmp_path / "merged.tsv"), 256)
@@ -0,0 +1,33 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from generate import generate
+from synthetic import SRC
+
+ASSEMBLY_ARGS = ["--linker", "GGTGGAGGCGGTTCA", "--hinge", "GATCCG", "--order", "hl"]
+
+
+@pytest.fixture(scope="module")
+def exports(tmp_path_factory):
+    out = str(tmp_path_factory.mktemp("exports"))
+    generate(out, heavy_clones=300, light_clones=240, reads_per_clone=8, pairing_rate=0.8,
+             unassigned_rate=0.1, umi=True, c_gene=True, no_light=False, seed=0)
+    return out
+
+
+def run(script: str, cwd: str, *args: str) -> None:
+    subprocess.run([sys.executable, os.path.join(SRC, script), *args], cwd=cwd, check=True)
+
+
+@pytest.mark.parametrize("engine", ["in-memory", "streaming"])
+@pytest.mark.parametrize("intermediate", ["assembled.tsv", "assembled.parquet"])
+def test_fused_matches_two_steps(exports, tmp_path, engine, intermediate):
+    assembled, two_steps, fused = (str(tmp_path / name) for name in (intermediate, "two.tsv", "fused.tsv"))
+    run("main.py", exports, *ASSEMBLY_ARGS, "--engine", engine, "--output", assembled)
+    run("construct_annotations.py", exports, *ASSEMBLY_ARGS, "--input", assembled, "--output", two_steps)
+    run("assemble_annotate.py", exports, *ASSEMBLY_ARGS, "--engine", engine, "--output", fused)
+    with open(two_steps, "rb") as expected, open(fused, "rb") as actual:
+        assert actual.read() == expected.read()
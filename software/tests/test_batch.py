@@ -0,0 +1,41 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from generate import generate
+from synthetic import SRC
+
+ASSEMBLY_ARGS = ["--linker", "GGTGGAGGCGGTTCA", "--hinge", "GATCCG", "--order", "hl"]
+
+
+@pytest.fixture(scope="module")
+def samples(tmp_path_factory):
+    root = tmp_path_factory.mktemp("samples")
+    directories = {}
+    for seed in range(3):
+        directory = str(root / f"sample{seed}")
+        generate(directory, heavy_clones=100 * (seed + 1), light_clones=80 * (seed + 1), reads_per_clone=6,
+                 pairing_rate=0.8, unassigned_rate=0.1, umi=seed != 1, c_gene=True, no_light=False, seed=seed)
+        directories[f"S{seed}"] = directory
+    return directories
+
+
+def run(script: str, cwd: str, *args: str) -> None:
+    subprocess.run([sys.executable, os.path.join(SRC, script), *args], cwd=cwd, check=True)
+
+
+@pytest.mark.parametrize("budget", [[], ["--batch-memory", "0.001"]])
+def test_batch_as_single_samples(samples, tmp_path, budget):
+    manifest = tmp_path / "manifest.tsv"
+    manifest.write_text("sampleId\tdirectory\toutput\n" + "".join(
+        f"{sample}\t{directory}\tbatch-{tmp_path.name}.tsv\n" for sample, directory in samples.items()))
+    # no --jobs: the default, one worker per core, must run too
+    run("batch.py", str(tmp_path), *ASSEMBLY_ARGS, "--manifest", str(manifest))
+    run("batch.py", str(tmp_path), *ASSEMBLY_ARGS, "--manifest", str(manifest), "--jobs", "2", *budget)
+    for directory in samples.values():
+        run("assemble_annotate.py", directory, *ASSEMBLY_ARGS, "--output", "single.tsv")
+        with open(os.path.join(directory, "single.tsv"), "rb") as expected, \
+                open(os.path.join(directory, f"batch-{tmp_path.name}.tsv"), "rb") as actual:
+            assert actual.read() == expected.read()
@@ -0,0 +1,24 @@
+import numpy as np
+import polars as pl
+import pytest
+
+from construct_annotations import base36_encode, base36_encode_series
+
+
+@pytest.mark.parametrize("values", [
+    [],
+    [None],
+    [0, 0],
+    [0, 35, 36, 1295, 1296, None, 46655],
+    [36 ** 12 - 1, 36 ** 12, 2 ** 63 - 1, 7],
+    np.random.default_rng(0).integers(0, 2 ** 40, 10_000).tolist(),
+])
+def test_base36_encode_series_as_per_value(values):
+    encoded = base36_encode_series(pl.Series("start", values, dtype=pl.Int64))
+    assert encoded.name == "start"
+    assert encoded.to_list() == [None if v is None else base36_encode(v) for v in values]
+
+
+def test_base36_encode_series_rejects_negatives():
+    with pytest.raises(ValueError):
+        base36_encode_series(pl.Series([3, -1]))
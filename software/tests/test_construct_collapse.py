@@ -0,0 +1,52 @@
+import numpy as np
+import pytest
+
+from construct_collapse import collapse_parents
+
+
+def collapse_parents_quadratic(sequences, abundances, distance, ratio):
+    """Every sequence against every parent found before it, visited as
+    `collapse_parents` does."""
+    order = sorted(range(len(sequences)), key=lambda row: (-abundances[row], sequences[row]))
+    parents = list(range(len(sequences)))
+    kept = []
+    for row in order:
+        seq = sequences[row]
+        nearest = next((parent for parent in kept if len(sequences[parent]) == len(seq) and
+                        sum(a != b for a, b in zip(sequences[parent], seq)) <= distance), None)
+        if nearest is not None and abundances[nearest] >= ratio * abundances[row]:
+            parents[row] = nearest
+        else:
+            kept.append(row)
+    return parents
+
+
+def construct_families(seed: int, families: int = 60, members: int = 8):
+    """Sequences of a few lengths, each a random mutant of a family's founder."""
+    rng = np.random.default_rng(seed)
+    alphabet = np.array(list("ACDEFGHIKLMNPQRSTVWY"))
+    sequences = []
+    for _ in range(families):
+        founder = rng.choice(alphabet, rng.choice([9, 30, 31, 64]))
+        for _ in range(members):
+            seq = founder.copy()
+            positions = rng.choice(len(seq), rng.integers(0, 5), replace=False)
+            seq[positions] = rng.choice(alphabet, len(positions))
+            sequences.append("".join(seq))
+    # few distinct abundances, so ties are broken by sequence
+    abundances = rng.integers(1, 20, len(sequences)).astype(np.float64) ** 2
+    return sequences, abundances
+
+
+@pytest.mark.parametrize("distance", [1, 2, 3])
+@pytest.mark.parametrize("ratio", [1.0, 2.0])
+def test_collapse_as_quadratic(distance, ratio):
+    sequences, abundances = construct_families(seed=distance)
+    expected = collapse_parents_quadratic(sequences, abundances.tolist(), distance, ratio)
+    actual = collapse_parents(sequences, abundances, distance, ratio)
+    assert actual.tolist() == expected
+    assert (actual != np.arange(len(sequences))).any()
+
+
+def test_collapse_of_nothing():
+    assert collapse_parents([], np.array([]), 1, 1.0).tolist() == []
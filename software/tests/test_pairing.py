@@ -0,0 +1,95 @@
+import os
+
+import polars as pl
+import pytest
+
+import pairing
+from pairing import pair_alignments, pair_alignments_partitioned, scan_alignments
+from synthetic import sorted_pairs, write_alignments
+
+
+def scan(directory: str, unassigned: bool = False):
+    return [scan_alignments(os.path.join(directory, f"{chain}.alignments.tsv"), unassigned)
+            for chain in ("hc", "lc")]
+
+
+@pytest.mark.parametrize("diagnostics", [False, True])
+def test_hashed_read_ids_pair_as_strings(alignments_dir, diagnostics):
+    hc, lc = scan(alignments_dir, unassigned=diagnostics)
+    expected = pair_alignments(hc, lc, "string", diagnostics=diagnostics).collect()
+    actual = pair_alignments(hc, lc, "hash", diagnostics=diagnostics).collect()
+    assert actual.height > 0
+    assert sorted_pairs(actual, expected.columns).equals(sorted_pairs(expected))
+
+
+def test_reads_without_id_never_pair(tmp_path):
+    for chain in ("hc", "lc"):
+        pl.DataFrame({"cloneId": [0, 1, 2], "descrR1": ["@R:1", None, None]}).write_csv(
+            tmp_path / f"{chain}.alignments.tsv", separator="\t")
+    hc, lc = scan(str(tmp_path))
+    pairs = pair_alignments(hc, lc, "hash")
+    assert pairs.select("cloneId-IGHeavy", "cloneId-IGLight", "readCount").collect().rows() == [(0, 0, 1)]
+
+
+def assert_partitioned_pairs_as_in_memory(directory, no_light=False, **options):
+    hc_path, lc_path = (os.path.join(directory, f"{chain}.alignments.tsv") for chain in ("hc", "lc"))
+    unassigned = options.get("diagnostics", False)
+    expected = pair_alignments(
+        scan_alignments(hc_path, unassigned), None if no_light else scan_alignments(lc_path, unassigned),
+        options.get("read_id_key", "string"), diagnostics=unassigned,
+        umi_sets=options.get("umi_sets", False)).collect()
+    actual = pair_alignments_partitioned(hc_path, None if no_light else lc_path, **options).collect()
+    assert sorted(actual.columns) == sorted(expected.columns)
+    assert sorted_pairs(actual, expected.columns).equals(sorted_pairs(expected))
+
+
+@pytest.mark.parametrize("partitions", [1, 7])
+@pytest.mark.parametrize("read_id_key", ["string", "hash"])
+@pytest.mark.parametrize("diagnostics", [False, True])
+@pytest.mark.parametrize("umi_sets", [False, True])
+def test_partitioned_pairs_as_in_memory(alignments_dir, monkeypatch, partitions, read_id_key,
+                                        diagnostics, umi_sets):
+    # several spill chunks per export, so buckets are written in parts
+    monkeypatch.setattr(pairing, "SPILL_ROWS", 500)
+    assert_partitioned_pairs_as_in_memory(
+        alignments_dir, partitions=partitions, read_id_key=read_id_key,
+        diagnostics=diagnostics, umi_sets=umi_sets)
+
+
+@pytest.mark.parametrize("umi", [False, True])
+def test_partitioned_heavy_only_pairs_as_in_memory(tmp_path, monkeypatch, umi):
+    monkeypatch.setattr(pairing, "SPILL_ROWS", 500)
+    write_alignments(str(tmp_path), seed=2, umi=umi)
+    assert_partitioned_pairs_as_in_memory(str(tmp_path), no_light=True, partitions=5)
+
+
+@pytest.mark.parametrize("diagnostics", [False, True])
+def test_partitioned_pairs_without_shared_reads(tmp_path, diagnostics):
+    write_alignments(str(tmp_path / "hc"), seed=3)
+    write_alignments(str(tmp_path / "lc"), seed=3, first_read=10_000)
+    os.replace(tmp_path / "hc" / "hc.alignments.tsv", tmp_path / "hc.alignments.tsv")
+    os.replace(tmp_path / "lc" / "lc.alignments.tsv", tmp_path / "lc.alignments.tsv")
+    assert_partitioned_pairs_as_in_memory(str(tmp_path), partitions=3, diagnostics=diagnostics)
+
+
+def test_partitioned_pairs_in_worker_processes(alignments_dir):
+    assert_partitioned_pairs_as_in_memory(alignments_dir, partitions=4, workers=2)
+
+
+@pytest.mark.parametrize("umi_sets", [False, True])
+def test_partitioned_umis_are_merged_a_pair_bucket_at_a_time(monkeypatch, tmp_path, umi_sets):
+    write_alignments(str(tmp_path), seed=7, reads=20_000, clones=200)
+    merged_rows = []
+    merge_pair_bucket = pairing.merge_pair_bucket
+
+    def counting_merge(bucket_dir, *args):
+        merged_rows.append(pl.scan_parquet(os.path.join(bucket_dir, "umis-*.parquet"))
+                           .select(pl.len()).collect().item())
+        merge_pair_bucket(bucket_dir, *args)
+
+    monkeypatch.setattr(pairing, "merge_pair_bucket", counting_merge)
+    partitions = 8
+    assert_partitioned_pairs_as_in_memory(str(tmp_path), partitions=partitions, umi_sets=umi_sets)
+    # no merge holds more than about its share of the sample's (pair, UMI) rows
+    assert len(merged_rows) == partitions
+    assert max(merged_rows) < 1.5 * sum(merged_rows) / partitions
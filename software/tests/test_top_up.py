@@ -0,0 +1,98 @@
+import hashlib
+import os
+
+import numpy as np
+import polars as pl
+import pytest
+
+from pairing import (FRACTION_COLS, PAIR_TABLE_COLS, encode_umis, pair_alignments, scan_alignments,
+                     top_up_pairs, umi_set_expr, write_pairs)
+from synthetic import sorted_pairs, write_alignments
+
+CHAINS = {"hc": "IGHeavy", "lc": "IGLight"}
+CLONES = 40
+
+
+def scan(directory: str):
+    return [scan_alignments(os.path.join(directory, f"{chain}.alignments.tsv")) for chain in CHAINS]
+
+
+def renumber(directory: str, permutations: dict) -> None:
+    """Rewrites the cloneIds of the exports in `directory`, as re-assembling
+    the clones of a topped-up sample would."""
+    for chain, permutation in permutations.items():
+        path = os.path.join(directory, f"{chain}.alignments.tsv")
+        alignments = pl.read_csv(path, separator="\t")
+        # unassigned reads (-1) keep their id
+        alignments.with_columns(pl.col("cloneId").replace_strict(
+            list(range(CLONES)), permutation.tolist(), default=-1)
+        ).write_csv(path, separator="\t")
+
+
+@pytest.mark.parametrize("renumbered", [False, True])
+def test_top_up_pairs_as_all_reads(tmp_path, renumbered):
+    previous_dir, new_dir, all_dir = (str(tmp_path / name) for name in ("previous", "new", "all"))
+    # the batches share UMIs but not reads
+    write_alignments(previous_dir, seed=4, clones=CLONES)
+    write_alignments(new_dir, seed=5, clones=CLONES, first_read=10_000)
+    os.makedirs(all_dir)
+    for chain in CHAINS:
+        pl.concat([pl.read_csv(os.path.join(d, f"{chain}.alignments.tsv"), separator="\t")
+                   for d in (previous_dir, new_dir)]
+                  ).write_csv(os.path.join(all_dir, f"{chain}.alignments.tsv"), separator="\t")
+
+    previous_path = str(tmp_path / "previous.parquet")
+    write_pairs(pair_alignments(*scan(previous_dir), umi_sets=True).collect(), previous_path, umi_sets=True)
+    clone_map = None
+    if renumbered:
+        rng = np.random.default_rng(6)
+        permutations = {chain: rng.permutation(CLONES) for chain in CHAINS}
+        renumber(new_dir, permutations)
+        renumber(all_dir, permutations)
+        clone_map = pl.concat([pl.DataFrame({
+            "chain": CHAINS[chain], "previousCloneId": np.arange(CLONES), "cloneId": permutation})
+            for chain, permutation in permutations.items()])
+
+    cols = PAIR_TABLE_COLS + FRACTION_COLS
+    expected = pair_alignments(*scan(all_dir)).collect().select(cols)
+    actual = top_up_pairs(previous_path, pair_alignments(*scan(new_dir), umi_sets=True), clone_map).collect()
+    assert sorted_pairs(actual, cols).equals(sorted_pairs(expected))
+
+
+def test_clone_map_without_a_previous_clone_is_rejected(tmp_path):
+    write_alignments(str(tmp_path), seed=4, clones=CLONES)
+    previous_path = str(tmp_path / "previous.parquet")
+    pairs = pair_alignments(*scan(str(tmp_path)), umi_sets=True)
+    write_pairs(pairs.collect(), previous_path, umi_sets=True)
+    clone_map = pl.DataFrame({"chain": "IGHeavy", "previousCloneId": [0], "cloneId": [0]})
+    with pytest.raises(ValueError, match="no IGHeavy cloneId"):
+        top_up_pairs(previous_path, pairs, clone_map)
+
+
+def test_top_up_needs_umi_sets(tmp_path):
+    write_alignments(str(tmp_path), seed=4, clones=CLONES)
+    previous_path = str(tmp_path / "previous.parquet")
+    write_pairs(pair_alignments(*scan(str(tmp_path))).collect(), previous_path)
+    with pytest.raises(ValueError, match="--pairs-umi-sets"):
+        top_up_pairs(previous_path, pair_alignments(*scan(str(tmp_path)), umi_sets=True))
+
+
+def test_umi_keys_are_stable():
+    # the keys are stored in UMI sets, so they must not change with polars
+    umis = pl.DataFrame({"tagValueUMI": ["ACGT", "ACGN", None], "tagValueUMI2": ["AC", "", "GGN"]})
+    keys = encode_umis(umis.lazy()).collect()
+    hashed = int.from_bytes(
+        hashlib.blake2b(b"ACGN", digest_size=8, key=b"tagValueUMI").digest(), "little") | 1 << 63
+    assert keys.get_column("tagValueUMI").to_list() == [int("10123", 4), hashed, None]
+    assert keys.select(umi_set_expr(list(umis.columns))).to_series().to_list() == [
+        8432628104153661312, 8919158575489659696, 10995357442686606455]
+
+
+def test_top_up_refuses_umi_sets_of_another_scheme(tmp_path):
+    write_alignments(str(tmp_path), seed=4, clones=CLONES)
+    previous_path = str(tmp_path / "previous.parquet")
+    pairs = pair_alignments(*scan(str(tmp_path)), umi_sets=True)
+    # a table written before the scheme was recorded
+    pairs.collect().write_parquet(previous_path)
+    with pytest.raises(ValueError, match="older scheme"):
+        top_up_pairs(previous_path, pairs)
@@ -0,0 +1,52 @@
+from typing import Optional
+
+import numpy as np
+import polars as pl
+import pytest
+
+from translation import GENETIC_CODE, replace_stop_codons, stop_codon_code, translate
+
+
+def replace_stop_codons_per_row(aa: Optional[str], nt: Optional[str], code: dict) -> Optional[str]:
+    marked = translate(nt, code)
+    if aa is None or marked is None or len(marked) != len(aa):
+        return aa
+    return "".join(m.upper() if a == "*" and m.islower() else a for a, m in zip(aa, marked))
+
+
+def random_rows(seed: int, rows: int = 2000):
+    rng = np.random.default_rng(seed)
+    nts, aas = [], []
+    for _ in range(rows):
+        # mostly stop-rich ACGT, with N, lower case and incomplete codons
+        nt = "".join(rng.choice(list("ACGTTTAGAN"), rng.integers(0, 40)))
+        if rng.random() < 0.1:
+            nt = nt.lower()
+        aa = translate(nt, GENETIC_CODE)
+        if aa is not None and rng.random() < 0.2:
+            # stops where the codon is not one, and frameshifted rows
+            aa = "".join("*" if rng.random() < 0.2 else c for c in aa)
+        if aa is not None and rng.random() < 0.1:
+            aa = aa[:-1]
+        nts.append(None if rng.random() < 0.05 else nt)
+        aas.append(None if rng.random() < 0.05 else aa)
+    return pl.Series("aa", aas, dtype=pl.String), pl.Series("nt", nts, dtype=pl.String)
+
+
+@pytest.mark.parametrize("replacements", [
+    {"amber": "Q"},
+    {"amber": "Q", "ochre": "Y", "opal": "W"},
+    {"amber": "*", "opal": "C"},
+])
+def test_replace_stop_codons_as_per_row(replacements):
+    code = stop_codon_code(replacements)
+    aa, nt = random_rows(seed=len(replacements))
+    expected = [replace_stop_codons_per_row(a, n, code) for a, n in zip(aa.to_list(), nt.to_list())]
+    actual = replace_stop_codons(aa, nt, code)
+    assert actual.name == "aa"
+    assert actual.to_list() == expected
+
+
+def test_replace_stop_codons_without_replaced_stops():
+    aa, nt = pl.Series(["M*"]), pl.Series(["ATGTAA"])
+    assert replace_stop_codons(aa, nt, stop_codon_code({"amber": "Q"})).to_list() == ["M*"]